@@ -7,10 +7,10 @@ Derivation of High Accuracy Road Centrelines Thiessen Polygons Technique"
 (http://proceedings.esri.com/library/userconf/proc96/TO400/PAP370/P370.HTM).
 
 Required dependencies:
-  - qhull binary (http://www.qhull.org)
+  - scipy (http://www.scipy.org) or qhull binary (http://www.qhull.org)
   - shapely (http://pypi.python.org/pypi/Shapely)
   - pyproj (http://code.google.com/p/pyproj)
-  - networkx (http://networkx.lanl.gov)
+  - networkx, optional (http://networkx.lanl.gov)
 
 You'd typically use it via one of the provided utility scripts, currently
 just these three:
@@ -30,48 +30,58 @@ skeletron-osm-route-rels.py
   using the "network", "ref" and "modifier" tags to group relations.
   More on route relations: http://wiki.openstreetmap.org/wiki/Relation:route
 """
-__version__ = '0.10.0'
+__version__ = '0.11.0'
 
-from subprocess import Popen, PIPE
-from itertools import combinations
 from tempfile import mkstemp
 from os import write, close
 from math import sin, cos, pi
 from math import ceil, atan2
+from itertools import imap, izip, islice
+from multiprocessing import cpu_count
+from collections import deque
 from time import time
 
-from threading import Timer
-from thread import interrupt_main
-
 import logging
     
 import numpy, numpy.linalg
-from shapely.geometry import Point, LineString, Polygon, MultiLineString, MultiPolygon
+from shapely.geometry import LineString, Polygon, MultiLineString, MultiPolygon
 from pyproj import Proj
 
-try:
-    from networkx.algorithms.shortest_paths.astar import astar_path
-    from networkx.exception import NetworkXNoPath
-    from networkx import Graph
-except ImportError:
-    # won't work but we can muddle through
-    pass
-
 mercator = Proj('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs +over')
 
-from .util import simplify_line_vw, simplify_line_dp, densify_line, \
-                  polygon_rings, cascaded_union, point_distance
+def mercator_lines(lines, inverse=False):
+    ''' Project a list of coordinate sequences with a single call to mercator.
+        
+        Return a list of (n, 2) arrays, one for each sequence.
+    '''
+    arrays = [numpy.asarray(line, dtype=float).reshape(-1, 2) for line in lines]
+    
+    if not arrays:
+        return []
+    
+    coords = numpy.concatenate(arrays)
+    
+    if len(coords):
+        xs, ys = mercator(coords[:,0], coords[:,1], inverse=inverse)
+        coords = numpy.column_stack((xs, ys))
+    
+    return numpy.split(coords, numpy.cumsum(map(len, arrays))[:-1])
 
-class _QHullFailure (Exception): pass
-class _SignalAlarm (Exception): pass
+from .util import simplify_line_vw, simplify_line_dp, densify_line, \
+                  polygon_rings, cascaded_union, polygon_containment, \
+                  Deadline, _DeadlineExceeded
+from .voronoi import voronoi_backend, _QHullFailure
+from .skeleton import Skeleton, prune_spurs, astar_path, long_path_decomposition, _NoPath
 
 class _GraphRoutesOvertime (Exception):
+    ''' Raised when a deadline runs out in multigeom_centerline().
+    
+        The graph attribute holds the list of offending skeleton graphs,
+        or the buffer polygon if time ran out before they were complete.
+    '''
     def __init__(self, graph):
         self.graph = graph
 
-def timeout():
-    interrupt_main()
-
 def _buffered_multiline_polygon(multiline, buffer):
     ''' Return a polygon shell with the given buffer around a multiline.
     '''
@@ -106,7 +116,33 @@ def _buffered_multipoly_polygon(multipoly, buffer):
     polygons = [poly.buffer(buffer, 3) for poly in polygons]
     return cascaded_union(polygons)
 
-def multigeom_centerline(multigeom, buffer=20, density=10, min_length=40, min_area=100):
+def _pool_results(pool, func, args):
+    ''' Generate func(arg) for each of args in order, computed in a multiprocessing.Pool.
+    
+        Unlike pool.imap(), tasks are handed to the pool just a couple per
+        CPU at a time, so closing this generator early leaves little work
+        abandoned. Closing it waits for tasks already handed out, so that
+        the pool is free again for whatever comes next.
+    '''
+    args, pending = iter(args), deque()
+    
+    try:
+        for arg in islice(args, 2 * cpu_count()):
+            pending.append(pool.apply_async(func, (arg, )))
+        
+        while pending:
+            result = pending.popleft().get()
+            
+            for arg in islice(args, 1):
+                pending.append(pool.apply_async(func, (arg, )))
+            
+            yield result
+    
+    finally:
+        for result in pending:
+            result.wait()
+
+def multigeom_centerline(multigeom, buffer=20, density=10, min_length=40, min_area=100, voronoi=None, engine='astar', deadline=None, pool=None, cache=None):
     """ Coalesce a linear street network to a centerline.
     
         Accepts and returns instances of shapely LineString and MultiLineString.
@@ -129,10 +165,43 @@ def multigeom_centerline(multigeom, buffer=20, density=10, min_length=40, min_ar
             Minimum area of roads kinks for them to be maintained through
             generalization by util.simplify_line_vw(), should be approximately
             one quarter of buffer squared.
+        
+          voronoi
+            Voronoi backend passed to polygon_dots_skeleton(), see
+            Skeletron.voronoi for choices. Default is None.
+        
+          engine
+            Route extraction engine passed to graph_routes(), either
+            "astar" or "diameter". Default is "astar".
+        
+          deadline
+            Optional util.Deadline instance checked while finding skeletons
+            and routes. Running out of time raises _GraphRoutesOvertime.
+            Each graph also gets its own time limit in graph_routes().
+        
+          pool
+            Optional multiprocessing.Pool, used to skeletonize buffer polygon
+            parts and their subdivisions from polygon_dots_parts() concurrently.
+            If one part runs out of time, parts not yet started are skipped.
+          
+          cache
+            Optional cache.Cache instance. Centerlines are looked up there
+            by geometry and arguments before any work is done, and stored
+            there afterwards. Overtime and other errors are not cached.
     """
     if not multigeom:
         return False
     
+    if cache:
+        key = cache.key(multigeom, buffer, density, min_length, min_area, voronoi, engine)
+        centerline = cache.get(key)
+        
+        if centerline is None:
+            centerline = multigeom_centerline(multigeom, buffer, density, min_length, min_area, voronoi, engine, deadline, pool)
+            cache.put(key, centerline)
+        
+        return centerline
+    
     if multigeom.type == 'MultiLineString':
         buffered = _buffered_multiline_polygon(multigeom, buffer)
         
@@ -145,34 +214,45 @@ def multigeom_centerline(multigeom, buffer=20, density=10, min_length=40, min_ar
     lines, points = [], 0
     
     #
-    # Iterate over each constituent buffer polygon, extending the skeleton.
+    # Divide each constituent buffer polygon into independent parts,
+    # and extend the skeleton with the centerlines from each one.
     #
     
-    for polygon in getattr(buffered, 'geoms', [buffered]):
-        try:
-            skeletons = polygon_skeleton_graphs(polygon, buffer, density)
-        
-        except _QHullFailure, e:
-            #
-            # QHull failures here are usually signs of tiny geometries,
-            # so they are usually fine to ignore completely and move on.
-            #
-            logging.error('QHull failure: %s' % e)
+    parts = [part for polygon in getattr(buffered, 'geoms', [buffered])
+             for part in polygon_dots_parts(polygon, buffer, density)]
+    
+    args = [(_poly, _points, min_length, min_area, voronoi, engine, deadline)
+            for (_poly, _points) in parts]
+    
+    if pool:
+        results = _pool_results(pool, _polygon_dots_centerlines, args)
+    else:
+        results = imap(_polygon_dots_centerlines, args)
+    
+    try:
+        for ((_poly, _points), (_lines, _count, failure, overtime)) in izip(parts, results):
+            if failure:
+                #
+                # QHull failures here are usually signs of tiny geometries,
+                # so they are usually fine to ignore completely and move on.
+                #
+                logging.error('QHull failure: %s' % failure)
+                
+                handle, fname = mkstemp(dir='.', prefix='qhull-failure-', suffix='.txt')
+                write(handle, 'Error: %s\nDensity: %.6f\nPolygon: %s\n' % (failure, density, str(_poly)))
+                close(handle)
+                continue
             
-            handle, fname = mkstemp(dir='.', prefix='qhull-failure-', suffix='.txt')
-            write(handle, 'Error: %s\nDensity: %.6f\nPolygon: %s\n' % (e, density, str(polygon)))
-            close(handle)
-            continue
-        
-        try:
-            routes = skeleton_routes(skeletons, min_length)
-
-        except _SignalAlarm, e:
-            # An alarm signal here means that graph_routes() went overtime.
-            raise _GraphRoutesOvertime(skeletons)
-        
-        points += sum(map(len, routes))
-        lines.extend([simplify_line_vw(route, min_area) for route in routes])
+            if overtime:
+                raise _GraphRoutesOvertime(overtime)
+            
+            points += _count
+            lines.extend(_lines)
+    
+    finally:
+        if pool:
+            # skip or wait for any parts left behind by an exception.
+            results.close()
     
     logging.debug('selected %d final points from %d graph route points' % (sum(map(len, lines)), points))
     
@@ -181,38 +261,72 @@ def multigeom_centerline(multigeom, buffer=20, density=10, min_length=40, min_ar
     
     return MultiLineString(lines)
 
-def graph_routes(graph, find_longest, time_coefficient=0.02):
+def _polygon_dots_centerlines(args):
+    """ Return centerlines for one part of a buffer polygon from polygon_dots_parts().
+    
+        Called from multigeom_centerline(), possibly in a worker process.
+        Return a tuple with a list of simplified lines, a count of route
+        points, a QHull failure message, and an offending graph or polygon
+        if a deadline ran out. Failures are returned instead of raised so
+        that they survive the trip back from another process.
+    """
+    polygon, points, min_length, min_area, voronoi, engine, deadline = args
+    
+    try:
+        skeleton = polygon_dots_skeleton(polygon, points, voronoi, deadline)
+    
+    except _QHullFailure, e:
+        return [], 0, str(e) or 'Unknown', None
+    
+    except _DeadlineExceeded, e:
+        # Out of time before the skeleton was even done.
+        return [], 0, None, polygon
+    
+    try:
+        routes = skeleton_routes([skeleton], min_length, engine, deadline)
+
+    except _DeadlineExceeded, e:
+        # This means that graph_routes() went overtime.
+        return [], 0, None, [skeleton]
+    
+    lines = [simplify_line_vw(route, min_area) for route in routes]
+    
+    return lines, sum(map(len, routes)), None, None
+
+def graph_routes(graph, find_longest, time_coefficient=0.02, engine='astar', deadline=None):
     """ Return a list of routes through a network as (x, y) pair lists, with no edge repeated.
     
-        Use a thread timer to check for time overruns; see _graph_routes_main()
-        for in-thread logic.
+        Set a time limit based on graph size and time_coefficient, within any
+        optional deadline, and check it as routes are found. Raise util._DeadlineExceeded
+        on overruns; see _graph_routes_main() and _graph_routes_diameter()
+        for the route-finding logic, selected by engine argument "astar" or "diameter".
     """
+    if engine == 'astar':
+        graph_routes_engine = _graph_routes_main
+    elif engine == 'diameter':
+        graph_routes_engine = _graph_routes_diameter
+    else:
+        raise ValueError('Unknown graph routes engine "%s"' % engine)
+    
     #
     # Before we do anything else, set a time limit to deal with the occasional
-    # halting problem on larger graphs. Use a threading Timer to check time.
+    # halting problem on larger graphs. The engine checks it cooperatively.
     #
     time_limit = 3 + int(ceil(time_coefficient * graph.number_of_nodes()))
+    deadline = (deadline or Deadline()).limit(time_limit)
 
-    try:
-        t = Timer(time_limit, timeout)
-        t.start()
-        routes = _graph_routes_main(graph, find_longest, time_coefficient)
-        t.cancel()
-        return routes
-    
-    except:
-        t.cancel()
-        raise _SignalAlarm('Timeout')
+    return graph_routes_engine(graph, find_longest, deadline)
 
-def _graph_routes_main(graph, find_longest, time_coefficient=0.02):
+def _graph_routes_main(graph, find_longest, deadline=None):
     """ Return a list of routes through a network as (x, y) pair lists, with no edge repeated.
     
         Called from graph_routes().
     
-        Each node in the graph must have a "point" attribute with a Point object.
+        The graph is a Skeleton instance, see Skeletron.skeleton.
         
-        The time_coefficient argument helps determine a time limit after which
-        this function is killed off by means of a SIGALRM. With the addition of
+        The time_coefficient argument to graph_routes() helps determine a time
+        limit after which this function gives up, by way of the deadline that
+        it checks for every path it tries. With the addition of
         divide_points() in polygon_skeleton_graphs() as of version 0.6.0, this
         condition is much less likely to actually happen.
 
@@ -232,51 +346,69 @@ def _graph_routes_main(graph, find_longest, time_coefficient=0.02):
         - Green trend line: y = 2.772e-5x^1.3176
         - Black upper bounds: y = 0.000001x^2
     """
-    # it's destructive
-    _graph = graph.copy()
-    
-    start_nodes, start_time = _graph.number_of_nodes(), time()
+    start_nodes, start_time = graph.number_of_nodes(), time()
     
-    # passed directly to shortest_path()
-    weight = find_longest and 'length' or None
+    # it's destructive, so keep track of used edges and node degrees here
+    edge_alive = [True] * graph.number_of_edges()
+    degree = graph.degrees()
+    edge_count = graph.number_of_edges()
     
-    # heuristic function for A* path-finding functions, see also:
-    # http://networkx.lanl.gov/reference/algorithms.shortest_paths.html#module-networkx.algorithms.shortest_paths.astar
-    heuristic = lambda n1, n2: point_distance(_graph.node[n1]['point'], _graph.node[n2]['point'])
+    xs, ys, indptr, indices, edge_ids, lengths = graph.as_lists()
     
     routes = []
     
     while True:
-        if not _graph.edges():
+        if not edge_count:
             break
+        
+        if deadline:
+            deadline.check()
     
-        leaves = [index for index in _graph.nodes() if _graph.degree(index) == 1]
+        leaves = numpy.flatnonzero(degree == 1)
         
         if len(leaves) == 1 or not find_longest:
             # add Y-junctions because with a single leaf, we'll get nowhere
-            leaves += [index for index in _graph.nodes() if _graph.degree(index) == 3]
+            leaves = numpy.concatenate((leaves, numpy.flatnonzero(degree == 3)))
         
         if len(leaves) == 0:
             # just pick an arbitrary node and its neighbor out of the infinite loop
-            node = [index for index in _graph.nodes() if _graph.degree(index) == 2][0]
-            neighbor = _graph.neighbors(node)[0]
-            leaves = [node, neighbor]
-
-        distances = [(point_distance(_graph.node[v]['point'], _graph.node[w]['point']), v, w)
-                     for (v, w) in combinations(leaves, 2)]
+            node = numpy.flatnonzero(degree == 2)[0]
+            neighbor = [indices[offset] for offset in range(indptr[node], indptr[node + 1])
+                        if edge_alive[edge_ids[offset]]][0]
+            leaves = numpy.array([node, neighbor])
+        
+        #
+        # Distances between all pairs of leaves, sorted just like
+        # a list of (distance, v, w) tuples from itertools.combinations().
+        #
+        vs, ws = numpy.triu_indices(len(leaves), 1)
+        vs, ws = leaves[vs], leaves[ws]
+        distances = numpy.hypot(graph.points[vs,0] - graph.points[ws,0],
+                                graph.points[vs,1] - graph.points[ws,1])
         
-        for (distance, v, w) in sorted(distances, reverse=find_longest):
+        order = numpy.lexsort((ws, vs, distances))
+        order = order[::-1] if find_longest else order
+        
+        for (v, w) in zip(vs[order].tolist(), ws[order].tolist()):
+            if deadline:
+                deadline.check()
+            
             try:
-                indexes = astar_path(_graph, v, w, heuristic, weight)
-            except NetworkXNoPath:
+                indexes = astar_path(graph, edge_alive, v, w, find_longest)
+            except _NoPath:
                 # try another
                 continue
     
             for (v, w) in zip(indexes[:-1], indexes[1:]):
-                _graph.remove_edge(v, w)
+                for offset in range(indptr[v], indptr[v + 1]):
+                    if indices[offset] == w and edge_alive[edge_ids[offset]]:
+                        edge_alive[edge_ids[offset]] = False
+                        break
+                degree[v] -= 1
+                degree[w] -= 1
+                edge_count -= 1
             
-            points = [_graph.node[index]['point'] for index in indexes]
-            coords = [(point.x, point.y) for point in points]
+            coords = [(xs[index], ys[index]) for index in indexes]
             routes.append(coords)
             
             # move on to the next possible route
@@ -286,45 +418,82 @@ def _graph_routes_main(graph, find_longest, time_coefficient=0.02):
 
     return routes
 
+def _graph_routes_diameter(graph, find_longest, deadline=None):
+    """ Return a list of routes through a network as (x, y) pair lists, with no edge repeated.
+    
+        Called from graph_routes().
+        
+        Splits the graph into long paths with a single sweep per connected
+        component using skeleton.long_path_decomposition(), instead of the
+        repeated leaf-to-leaf searches in _graph_routes_main(). Runs in
+        O(n log n) time and always prefers longer routes, so find_longest
+        is accepted for compatibility and ignored.
+    """
+    xs, ys = graph.points[:,0].tolist(), graph.points[:,1].tolist()
+    paths = long_path_decomposition(graph, deadline)
+    
+    return [[(xs[index], ys[index]) for index in path] for path in paths]
+
 def waynode_multilines(ways, nodes):
-    """ Convert dictionaries of ways and nodes to dictionary of multilines.
+    """ Convert a dictionary of ways and a NodeStore of nodes to dictionary of multilines.
     """
     multilines = dict()
+    keys, node_ids = [], []
     
     for way in ways.values():
-        key = way['key']
-        node_ids = way['nodes']
-        
-        if len(node_ids) < 2:
+        if len(way['nodes']) < 2:
             continue
         
+        keys.append(way['key'])
+        node_ids.append(way['nodes'])
+    
+    if not keys:
+        return multilines
+    
+    #
+    # Look up all the node locations at once and deal them back out
+    # to ways, dropping any missing nodes and ways left too short.
+    #
+    lats, lons, found = nodes.locations(numpy.concatenate(node_ids))
+    offsets = numpy.cumsum(map(len, node_ids))[:-1]
+    lines = numpy.split(numpy.column_stack((lons, lats)), offsets)
+    
+    if not found.all():
+        lines = [line[line_found] for (line, line_found) in izip(lines, numpy.split(found, offsets))]
+        keys, lines = zip(*[(key, line) for (key, line) in izip(keys, lines) if len(line) >= 2]) or ([], [])
+    
+    for (key, line) in izip(keys, mercator_lines(lines)):
         if key not in multilines:
             multilines[key] = []
         
-        points = [mercator(*reversed(nodes[id])) for id in node_ids]
-        multilines[key].append(LineString(points))
+        multilines[key].append(line)
     
     for (key, lines) in multilines.items():
-        lines = [list(line.coords) for line in lines]
         multilines[key] = MultiLineString(lines)
     
     return multilines
 
-def _m(geom):
-    ''' Project the coordinates of a geometry such as a line or ring.
-    '''
-    return [mercator(x, y) for (x, y) in geom.coords]
-
 def projected_multigeometry(geom):
     ''' Accept an unprojected geometry and return a projected multigeometry.
     '''
     geoms = getattr(geom, 'geoms', [geom])
     
     if geom.type in ('LineString', 'MultiLineString'):
-        projected = MultiLineString(map(_m, geoms))
+        projected = MultiLineString(mercator_lines([line.coords for line in geoms]))
     
     elif geom.type in ('Polygon', 'MultiPolygon'):
-        parts = [(_m(poly.exterior), map(_m, poly.interiors)) for poly in geoms]
+        #
+        # Project every ring of every polygon in one go,
+        # and then deal them back out to their polygons.
+        #
+        rings = [[poly.exterior] + list(poly.interiors) for poly in geoms]
+        coords = mercator_lines([ring.coords for ring in sum(rings, [])])
+        parts = []
+        
+        for poly_rings in rings:
+            poly_coords, coords = coords[:len(poly_rings)], coords[len(poly_rings):]
+            parts.append((poly_coords[0], poly_coords[1:]))
+        
         projected = MultiPolygon(parts)
     
     else:
@@ -332,6 +501,11 @@ def projected_multigeometry(geom):
     
     return projected
 
+def simplified_multiline(multiline, tolerance):
+    ''' Return a copy of a projected multiline simplified with util.simplify_line_dp().
+    '''
+    return MultiLineString([simplify_line_dp(list(line.coords), tolerance) for line in multiline.geoms])
+
 def geometry_multiline(geom):
     '''
     '''
@@ -339,8 +513,7 @@ def geometry_multiline(geom):
         raise ValueError("Can't generalize a %s geometry" % geom.type)
     
     geoms = geom.geoms if hasattr(geom, 'geoms') else [geom]
-    coords = [[mercator(x, y) for (x, y) in line.coords] for line in geoms]
-    projected = MultiLineString(coords)
+    projected = MultiLineString(mercator_lines([line.coords for line in geoms]))
     
     return projected
 
@@ -356,34 +529,41 @@ def multiline_polygon(multiline, buffer=20):
     polys = [line.buffer(buffer, 3) for line in multiline.geoms]
     return cascaded_union(polys)
 
-def polygon_skeleton_graphs(polygon, buffer=20, density=10):
+def polygon_skeleton_graphs(polygon, buffer=20, density=10, voronoi=None, deadline=None):
     """ Given a buffer polygon, return a list of skeleton graphs.
     """
-    points = []
+    return [polygon_dots_skeleton(_poly, _points, voronoi, deadline)
+            for (_poly, _points) in polygon_dots_parts(polygon, buffer, density)]
+
+def polygon_dots_parts(polygon, buffer=20, density=10):
+    """ Given a buffer polygon, return a list of (polygon, points) parts for polygon_dots_skeleton().
     
+        Parts are independent of one another, so their skeletons can be
+        found separately. Large polygons are subdivided with divide_points().
+    """
     #
-    # Build up a list of points by densifying the perimeter of each part
+    # Build up an array of points by densifying the perimeter of each part
     # of the polygon, resulting in a possibly lengthy list of (x, y) pairs.
     #
-    for ring in polygon_rings(polygon):
-        points.extend(densify_line(list(ring.coords), density))
+    rings = [densify_line(ring.coords, density) for ring in polygon_rings(polygon)]
+    points = numpy.concatenate([numpy.zeros((0, 2))] + rings)
     
     if len(points) <= 4:
         # Don't bother with very short lists of points.
-        return Graph()
+        return []
     
     max_points = 5000
 
     if len(points) < max_points:
         # Don't subdivide point collections smaller than max_points.
-        return [polygon_dots_skeleton(polygon, points)]
+        return [(polygon, points)]
     
     point_lists = [points]
-    skeletons = []
+    parts = []
     
     #
     # Subdivide large collections of points along their
-    # major axes, and make a skeleton for each subdivision.
+    # major axes, and make a part for each subdivision.
     #
     while point_lists:
         points1, points2, poly1, poly2 = divide_points(point_lists.pop(0))
@@ -393,11 +573,11 @@ def polygon_skeleton_graphs(polygon, buffer=20, density=10):
         for (_points, _poly) in ((points1, poly1), (points2, poly2)):
             if len(_points) < max_points:
                 _poly = _poly.buffer(buffer, 3).intersection(polygon)
-                skeletons.append(polygon_dots_skeleton(_poly, _points))
+                parts.append((_poly, _points))
             else:
                 point_lists.append(_points)
     
-    return skeletons
+    return parts
 
 def divide_points(points):
     ''' Divide a list of (x, y) tuples into two lists and two bounding polygons.
@@ -454,61 +634,37 @@ def divide_points(points):
     
     return points1, points2, polygon1, polygon2
 
-def polygon_dots_skeleton(polygon, points):
-    '''
-    '''
-    skeleton = Graph()
-
-    rbox = '\n'.join( ['2', str(len(points))] + ['%.2f %.2f' % (x, y) for (x, y) in points] + [''] )
+def polygon_dots_skeleton(polygon, points, voronoi=None, deadline=None):
+    ''' Given a buffer polygon and its perimeter points, return a Skeleton.
     
-    qvoronoi = Popen('qvoronoi o'.split(), stdin=PIPE, stdout=PIPE)
-    output, error = qvoronoi.communicate(rbox)
-    voronoi_lines = output.splitlines()
-    
-    if qvoronoi.returncode:
-        raise _QHullFailure('Failed with code %s' % qvoronoi.returncode)
-    
-    vert_count, poly_count = map(int, voronoi_lines[1].split()[:2])
-    
-    for (index, line) in enumerate(voronoi_lines[2:2+vert_count]):
-        point = Point(*map(float, line.split()[:2]))
-        if point.within(polygon):
-            skeleton.add_node(index, dict(point=point))
+        The voronoi argument selects a backend from Skeletron.voronoi
+        by name, or can be a backend function. The optional deadline
+        is checked on either side of the Voronoi diagram and while
+        pruning spurs.
+    '''
+    if deadline:
+        deadline.check()
     
-    for line in voronoi_lines[2+vert_count:2+vert_count+poly_count]:
-        indexes = map(int, line.split()[1:])
-        for (v, w) in zip(indexes, indexes[1:] + indexes[:1]):
-            if v not in skeleton.node or w not in skeleton.node:
-                continue
-            v1, v2 = skeleton.node[v]['point'], skeleton.node[w]['point']
-            line = LineString([(v1.x, v1.y), (v2.x, v2.y)])
-            if line.within(polygon):
-                skeleton.add_edge(v, w, dict(line=line, length=line.length))
+    vertices, ridges = voronoi_backend(voronoi)(points)
     
-    removing = True
+    if deadline:
+        deadline.check()
     
-    while removing:
-        removing = False
+    vertex_mask, ridge_mask = polygon_containment(polygon, vertices, ridges)
     
-        for index in skeleton.nodes():
-            if skeleton.degree(index) == 1:
-                depth = skeleton.node[index].get('depth', 0)
-                if depth < 20:
-                    other = skeleton.neighbors(index)[0]
-                    skeleton.node[other]['depth'] = depth + skeleton.edge[index][other]['line'].length
-                    skeleton.remove_node(index)
-                    removing = True
+    skeleton = Skeleton(vertices, ridges).subgraph(vertex_mask, ridge_mask)
+    skeleton = prune_spurs(skeleton, 20, deadline)
     
-    logging.debug('found %d skeleton edges' % len(skeleton.edge))
+    logging.debug('found %d skeleton edges' % skeleton.number_of_edges())
     
     return skeleton
 
-def skeleton_routes(skeletons, min_length=25):
+def skeleton_routes(skeletons, min_length=25, engine='astar', deadline=None):
     """ Given a list of skeleton graphs, return a series of (x, y) list routes ordered longest to shortest.
     """
     routes = []
     
     for skeleton in skeletons:
-        routes.extend(graph_routes(skeleton, True))
+        routes.extend(graph_routes(skeleton, True, engine=engine, deadline=deadline))
     
     return [route for route in routes if LineString(route).length > min_length]
@@ -0,0 +1,173 @@
+""" On-disk cache of generalized centerlines.
+
+Results of multigeom_centerline() are stored under a hash of the projected
+input geometry, the parameters used to generalize it and the version of
+Skeletron, so geometries that have not changed since the last run are
+served without any buffering or Voronoi work. Pass a Cache instance as the cache argument to functions in
+Skeletron.output or to multigeom_centerline().
+
+The cache is a plain directory of files, one per result, and is bounded in
+size by removing the least-recently-used files first.
+"""
+from os import listdir, makedirs, remove, rename, stat, utime, write, close
+from os.path import join, isdir
+from tempfile import mkstemp
+from hashlib import sha1
+from time import time
+
+import logging
+
+from shapely.wkb import loads as wkb_decode
+
+from . import __version__
+from .voronoi import voronoi_backend
+
+class Cache:
+    ''' Size-bounded directory of cached centerlines.
+        
+        Each result is a file named for its key, holding centerline WKB or
+        nothing at all for a centerline that could not be found. Files are
+        touched on every hit so that modification times order them by use,
+        and the oldest are removed when the total size passes max_size.
+        
+        The hits and misses attributes count lookups.
+    '''
+    def __init__(self, directory, max_size=100*1024*1024):
+        if not isdir(directory):
+            makedirs(directory)
+        
+        self.directory = directory
+        self.max_size = max_size
+        self.hits, self.misses = 0, 0
+        self._remove_stale_temporary_files()
+        self.size = sum([size for (path, size, mtime) in self._files()])
+    
+    def _remove_stale_temporary_files(self, max_age=3600):
+        ''' Remove temporary files left behind by writes that never finished.
+            
+            Only files older than max_age seconds are removed, so that
+            writes in progress in other processes are left alone.
+        '''
+        for filename in listdir(self.directory):
+            if not filename.startswith('tmp-'):
+                continue
+            
+            path = join(self.directory, filename)
+            
+            try:
+                if stat(path).st_mtime < time() - max_age:
+                    remove(path)
+            except OSError:
+                # removed or renamed by another process in the meantime
+                continue
+    
+    def _files(self):
+        ''' Return a list of (path, size, mtime) tuples for every cached file.
+        '''
+        files = []
+        
+        for dirname in listdir(self.directory):
+            if not isdir(join(self.directory, dirname)):
+                continue
+            
+            for filename in listdir(join(self.directory, dirname)):
+                path = join(self.directory, dirname, filename)
+                
+                try:
+                    info = stat(path)
+                except OSError:
+                    # removed by another process in the meantime
+                    continue
+                
+                files.append((path, info.st_size, info.st_mtime))
+        
+        return files
+    
+    def _path(self, key):
+        return join(self.directory, key[:2], key)
+    
+    def key(self, multigeom, buffer, density, min_length, min_area, voronoi, engine):
+        ''' Return a key for a projected geometry and multigeom_centerline() arguments.
+            
+            The voronoi argument is resolved to a backend function first,
+            so that None and the name of the default backend share a key.
+            Skeletron's version is part of the key, so that centerlines
+            cached by an earlier release are not reused after an upgrade.
+        '''
+        backend = voronoi_backend(voronoi)
+        backend = '%s.%s' % (backend.__module__, backend.__name__)
+        params = repr((__version__, buffer, density, min_length, min_area, backend, engine))
+        return sha1(multigeom.wkb + params).hexdigest()
+    
+    def get(self, key):
+        ''' Return a cached centerline, False for a cached failure, or None if not found.
+        '''
+        path = self._path(key)
+        
+        try:
+            data = open(path, 'rb').read()
+            utime(path, None)
+        
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        return data and wkb_decode(data) or False
+    
+    def put(self, key, centerline):
+        ''' Store a centerline or a False failure under a key.
+        '''
+        path = self._path(key)
+        data = centerline and centerline.wkb or ''
+        
+        if not isdir(join(self.directory, key[:2])):
+            try:
+                makedirs(join(self.directory, key[:2]))
+            except OSError:
+                # created by another process in the meantime
+                pass
+        
+        #
+        # Write to a temporary file and move it into place,
+        # so that readers never see a partially-written file.
+        #
+        handle, filename = mkstemp(dir=self.directory, prefix='tmp-')
+        write(handle, data)
+        close(handle)
+        
+        try:
+            # replacing an existing file, so don't count it twice
+            self.size -= stat(path).st_size
+        except OSError:
+            pass
+        
+        rename(filename, path)
+        
+        self.size += len(data)
+        
+        if self.size > self.max_size:
+            self.evict()
+    
+    def evict(self):
+        ''' Remove least-recently-used files down to nine tenths of max_size.
+            
+            Eviction scans the whole directory, so leaving some room
+            keeps it from happening on every subsequent put().
+        '''
+        files = sorted(self._files(), key=lambda (path, size, mtime): mtime)
+        self.size = sum([size for (path, size, mtime) in files])
+        
+        for (path, size, mtime) in files:
+            if self.size <= self.max_size * 9 / 10:
+                break
+            
+            try:
+                remove(path)
+            except OSError:
+                # removed by another process in the meantime
+                continue
+            
+            self.size -= size
+        
+        logging.debug('Cache is %d bytes after eviction' % self.size)
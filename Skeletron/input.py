@@ -1,6 +1,123 @@
-from copy import deepcopy
 from xml.parsers.expat import ParserCreate
+from multiprocessing import Pool
+from itertools import imap, islice
+from json import JSONDecoder, loads
 from logging import debug
+from array import array
+from re import compile
+
+import numpy
+
+from .pbf import read_blobs, check_header, decode_block
+
+_whitespace = compile(r'[ \t\n\r]*')
+
+class _JSONStream:
+    """ Incremental reader of JSON values from a file-like input.
+    
+        Used by geojson_features().
+    """
+    def __init__(self, input, chunk_size=65536):
+        self.input = input
+        self.chunk_size = chunk_size
+        self.decoder = JSONDecoder()
+        self.buffer, self.offset, self.eof = '', 0, False
+    
+    def fill(self):
+        """ Read more input into the buffer, return false at end of file.
+        """
+        chunk = self.input.read(max(self.chunk_size, len(self.buffer) - self.offset))
+        self.buffer = self.buffer[self.offset:] + chunk
+        self.offset = 0
+        self.eof = not chunk
+        
+        return not self.eof
+    
+    def peek(self):
+        """ Skip whitespace and return the next character, or an empty string at end of file.
+        """
+        while True:
+            self.offset = _whitespace.match(self.buffer, self.offset).end()
+            
+            if self.offset < len(self.buffer):
+                return self.buffer[self.offset]
+            
+            if not self.fill():
+                return ''
+    
+    def expect(self, chars):
+        """ Consume and return the next character, which must be one of chars.
+        """
+        char = self.peek()
+        
+        if not char or char not in chars:
+            raise ValueError('Expected one of %s at %s' % (repr(chars), repr(self.buffer[self.offset:self.offset+20])))
+        
+        self.offset += 1
+        return char
+    
+    def value(self):
+        """ Decode and return the next complete JSON value.
+        """
+        self.peek()
+        
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.offset)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            
+            if end == len(self.buffer) and not self.eof and self.fill():
+                # a number at the very end of the buffer might continue.
+                continue
+            
+            self.offset = end
+            return value
+
+def geojson_features(input):
+    """ Generate features from a GeoJSON FeatureCollection file one at a time.
+    
+        Reads input incrementally, so only the current feature and any
+        other small top-level members are held in memory.
+    """
+    stream = _JSONStream(input)
+    stream.expect('{')
+    
+    if stream.peek() == '}':
+        return
+    
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        
+        if key != 'features':
+            stream.value()
+        
+        elif stream.expect('[') and stream.peek() == ']':
+            stream.expect(']')
+        
+        else:
+            while True:
+                yield stream.value()
+                
+                if stream.expect(',]') == ']':
+                    break
+        
+        if stream.expect(',}') == '}':
+            break
+
+def geojsonseq_features(input):
+    """ Generate features from newline-delimited GeoJSON, one per line.
+    
+        Leading record separator characters from RFC 8142 are ignored.
+    """
+    for line in input:
+        line = line.lstrip('\x1e').strip()
+        
+        if line:
+            yield loads(line)
 
 def name_key(tags):
     """ Convert way tags to name keys.
@@ -57,67 +174,182 @@ def name_highway_ref_key(tags):
     
     return tags.get('name', None), tags.get('highway', None), tags.get('ref', None)
 
-def parse_street_waynodes(input, use_highway):
-    """ Parse OSM XML input, return ways and nodes for waynode_networks().
-    
+def _osm_parser(two_pass, pbf, workers):
+    """ Return a ParserPBF for PBF input or a ParserOSM for OSM XML input.
+    """
+    return pbf and ParserPBF(two_pass, workers) or ParserOSM(two_pass)
+
+def parse_street_waynodes(input, use_highway, two_pass=False, pbf=False, workers=1):
+    """ Parse OSM XML or PBF input, return ways and nodes for waynode_networks().
+        
         Uses name_highway_key() for way keys, ignores relations.
+        See ParserOSM for two_pass and ParserPBF for pbf and workers.
     """
     way_key = use_highway and name_highway_key or name_key
-    rels, ways, nodes = ParserOSM().parse(input, way_key=way_key)
+    rels, ways, nodes = _osm_parser(two_pass, pbf, workers).parse(input, way_key=way_key)
     
     return ways, nodes
 
-def parse_route_relation_waynodes(input, merge_highways):
-    """ Parse OSM XML input, return ways and nodes for waynode_networks().
+def update_street_waynodes(input, ways, nodes, use_highway):
+    """ Apply osmChange input to ways and nodes from parse_street_waynodes().
+        
+        Ways and nodes are updated in place. Return a set of way keys
+        whose multilines might have changed, including removed keys.
+    """
+    way_key = use_highway and name_highway_key or name_key
+    old_rels, old_ways = ParserOSC(dict(), ways, nodes).parse(input, way_key=way_key)
+    keys = set()
+    
+    for (way_id, old_way) in old_ways.items():
+        if old_way:
+            keys.add(old_way['key'])
+        
+        if way_id in ways:
+            keys.add(ways[way_id]['key'])
     
+    return keys
+
+def parse_route_relation_waynodes(input, merge_highways, two_pass=False, pbf=False, workers=1):
+    """ Parse OSM XML or PBF input, return ways and nodes for waynode_networks().
+        
         Uses network_ref_modifier_key() for relation keys, converts way keys to fit.
 
         Assumes correctly-tagged route relations:
             http://wiki.openstreetmap.org/wiki/Relation:route
     """
-    rels, ways, nodes = ParserOSM().parse(input, way_key=name_highway_ref_key, rel_key=network_ref_modifier_key)
+    rels, ways, nodes = parse_route_relations(input, two_pass, pbf, workers)
+    
+    return route_relation_waynodes(rels, ways, merge_highways), nodes
+
+def parse_route_relations(input, two_pass=False, pbf=False, workers=1):
+    """ Parse OSM XML or PBF input, return relations, ways and nodes for route_relation_waynodes().
+        
+        See ParserOSM for two_pass and ParserPBF for pbf and workers.
+    """
+    parser = _osm_parser(two_pass, pbf, workers)
+    return parser.parse(input, way_key=name_highway_ref_key, rel_key=network_ref_modifier_key)
+
+def update_route_relation_waynodes(input, rels, ways, nodes, merge_highways):
+    """ Apply osmChange input to relations, ways and nodes from parse_route_relations().
+        
+        Relations, ways and nodes are updated in place. Return new ways
+        from route_relation_waynodes() and a set of their keys whose
+        multilines might have changed, including removed keys.
+    """
+    old_keys = set([way['key'] for way in route_relation_waynodes(rels, ways, merge_highways).values()])
+    old_flat = flattened_relations(rels)
+    
+    old_rels, old_ways = ParserOSC(rels, ways, nodes).parse(input, way_key=name_highway_ref_key, rel_key=network_ref_modifier_key)
+    
+    rel_ways = route_relation_waynodes(rels, ways, merge_highways)
+    new_keys = set([way['key'] for way in rel_ways.values()])
+    new_flat = flattened_relations(rels)
     
     #
-    # Collapse subrelations to surface ways.
+    # Find network, ref and modifier of every top-level relation that
+    # used any changed way or relation before or after the change.
+    # With merge_highways set, highway values in keys can depend on
+    # every relation with the same network and ref, so all keys with
+    # the same network, ref and modifier are included.
     #
+    affected, changed_ways = set(), set(old_ways)
     
-    changing = True
-
-    while changing:
-        changing = False
+    for (key, way_ids, rel_ids) in old_flat.values() + new_flat.values():
+        if not rel_ids.isdisjoint(old_rels) or not changed_ways.isdisjoint(way_ids):
+            affected.add(key)
+    
+    keys = set([key for key in old_keys | new_keys if key[:3] in affected])
     
-        for rel in rels.values():
-            parts = rel['parts']
+    return rel_ways, keys
 
-            for (index, part) in enumerate(parts):
-                if part.startswith('rel:'):
-                    rel_id = part[4:]
+def flattened_relations(rels):
+    """ Collapse subrelations to surface ways, return a dictionary of top-level relations.
+        
+        Values are tuples with a relation key, a list of way ids, and a set
+        of relation ids including the top-level one and any subrelations.
+        Relations are not modified.
+        
+        Each subrelation is collapsed into the first relation found to use
+        it, in a depth-first walk over relations in dictionary order, and
+        is dropped from any others along with missing subrelations and
+        loops. Every relation is walked just once.
+    """
+    #
+    # First, find the one relation claiming each subrelation and the
+    # index of the part where it's claimed. Unclaimed relations are top-level.
+    #
+    claims = dict()
+    
+    for rel_id in rels:
+        if rel_id in claims:
+            continue
+        
+        claims[rel_id] = None
+        stack = [(rel_id, 0)]
+        
+        while stack:
+            parent_id, index = stack.pop()
+            parts = rels[parent_id]['parts']
+            
+            for index in range(index, len(parts)):
+                sub_id = parts[index][4:]
                 
-                    if rel_id in rels:
-                        # there's a matching subrelation, so pull all
-                        # its members up into this one looking for ways.
-
-                        parts[index:index+1] = rels[rel_id]['parts']
-                        del rels[rel_id]
-                        changing = True
-                    else:
-                        # no matching relation means drop it on the floor.
-                        parts[index:index+1] = []
-                        changing = True
+                if not parts[index].startswith('rel:') or sub_id not in rels:
+                    continue
+                
+                if sub_id not in claims or (claims[sub_id] is None and sub_id != rel_id):
+                    # unclaimed, or top-level relation seen earlier; resume
+                    # this relation after walking the claimed subrelation.
+                    claims[sub_id] = parent_id, index
+                    stack.extend([(parent_id, index + 1), (sub_id, 0)])
+                    break
+    
+    #
+    # Then, walk each top-level relation again to list its ways in order.
+    #
+    flat = dict()
+    
+    for (rel_id, rel) in rels.items():
+        if claims[rel_id] is not None:
+            continue
+        
+        way_ids, members = [], set([rel_id])
+        stack = [(rel_id, 0)]
+        
+        while stack:
+            parent_id, index = stack.pop()
+            parts = rels[parent_id]['parts']
             
-                elif part.startswith('way:'):
+            for index in range(index, len(parts)):
+                part = parts[index]
+                
+                if part.startswith('way:'):
                     # good, we want these
-                    pass
-            
-                else:
-                    # not sure what this is, can't be good.
-                    parts[index:index+1] = []
-                    changing = True
-            
-            if changing:
-                # rels was modified, try another round
-                break
+                    way_ids.append(part[4:])
+                
+                elif part.startswith('rel:'):
+                    sub_id = part[4:]
+                    members.add(sub_id)
+                    
+                    if claims.get(sub_id, None) == (parent_id, index):
+                        # there's a matching subrelation, so pull all
+                        # its members up into this one looking for ways.
+                        stack.extend([(parent_id, index + 1), (sub_id, 0)])
+                        break
+                    
+                    # otherwise, drop it on the floor.
+        
+        flat[rel_id] = rel['key'], way_ids, members
     
+    return flat
+
+def route_relation_waynodes(rels, ways, merge_highways):
+    """ Return ways for waynode_networks() with route relation keys.
+        
+        Accepts relations and ways from parse_route_relations(), which
+        are not modified. Member ways missing from ways are skipped.
+        Ways used by more than one relation share arrays of node ids.
+    """
     #
     # Apply relation keys to ways.
     #
@@ -127,22 +359,23 @@ def parse_route_relation_waynodes(input, merge_highways):
     highways = dict(motorway=9, trunk=8, primary=7, secondary=6, tertiary=5)
     net_refs = dict()
     
-    for rel in rels.values():
-        for part in rel['parts']:
-            # we know from above that they're all "way:".
-            way_id = part[4:]
+    for (rel_key, way_ids, rel_ids) in flattened_relations(rels).values():
+        for way_id in way_ids:
+            if way_id not in ways:
+                continue
             
-            # add the route relation key to the way
-            rel_way = deepcopy(ways[way_id])
+            # add the route relation key to a copy of the way,
+            # sharing its array of node ids with any other copies.
+            rel_way = dict(ways[way_id])
             way_name, way_hwy, way_ref = rel_way['key']
-            rel_net, rel_ref, rel_mod = rel['key']
+            rel_net, rel_ref, rel_mod = rel_key
             
             if merge_highways == 'yes':
                 rel_way['key'] = rel_net, rel_ref, rel_mod
 
             elif merge_highways == 'largest':
                 rel_way['key'] = rel_net, rel_ref, rel_mod
-                big_hwy = net_refs.get((rel_net, rel_ref), None)
+                big_hwy = net_refs.get((rel_net, rel_ref, rel_mod), None)
                 
                 if big_hwy is None or (highways.get(way_hwy, 0) > highways.get(big_hwy, 0)):
                     #
@@ -157,7 +390,7 @@ def parse_route_relation_waynodes(input, merge_highways):
             
             rel_ways[len(rel_ways)] = rel_way
     
-    debug('%d rel_ways, %d nodes' % (len(rel_ways), len(nodes)))
+    debug('%d rel_ways' % len(rel_ways))
     
     if merge_highways == 'largest':
         #
@@ -169,9 +402,172 @@ def parse_route_relation_waynodes(input, merge_highways):
             highway = net_refs[(network, ref, modifier)]
             rel_ways[key]['key'] = network, ref, modifier, highway
     
-    debug('%d rel_ways, %d nodes' % (len(rel_ways), len(nodes)))
+    return rel_ways
+
+class NodeStore:
+    """ Compact store of node locations for ParserOSM, keyed on integer ids.
+        
+        Locations live in arrays of sorted int64 ids and float latitudes and
+        longitudes, found by binary search at about 24 bytes per node. New,
+        changed and removed nodes are collected a million or so at a time
+        into chunks of arrays, and merged in all at once by the next lookup.
+        
+        If only is given as a sorted array of ids, any other nodes are
+        thrown away as each chunk is collected.
+    """
+    only = None
+    
+    def __init__(self, only=None):
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.lats = numpy.zeros(0, dtype=float)
+        self.lons = numpy.zeros(0, dtype=float)
+        self.only = only
+        self.chunks = []
+        self._reset()
+    
+    def _reset(self):
+        # Ids are kept in a list, because array('l') is only 32 bits on some platforms.
+        self.new_ids, self.new_lats, self.new_lons = [], array('d'), array('d')
+    
+    def _flush(self):
+        """ Move collected changes into a chunk of arrays, filtered by only.
+        """
+        if not len(self.new_ids):
+            return
+        
+        ids = numpy.array(self.new_ids, dtype=numpy.int64)
+        lats = numpy.frombuffer(self.new_lats, dtype=float).copy()
+        lons = numpy.frombuffer(self.new_lons, dtype=float).copy()
+        
+        self._reset()
+        self.extend(ids, lats, lons)
+    
+    def _merge(self):
+        """ Merge collected changes into the sorted arrays.
+        """
+        self._flush()
+        
+        if not self.chunks:
+            return
+        
+        chunk_ids, chunk_lats, chunk_lons = zip(*self.chunks)
+        ids = numpy.concatenate((self.ids, ) + chunk_ids)
+        lats = numpy.concatenate((self.lats, ) + chunk_lats)
+        lons = numpy.concatenate((self.lons, ) + chunk_lons)
+        self.chunks = []
+        
+        #
+        # A stable sort leaves the latest change to each node last among
+        # entries with its id. Keep just that one unless it's a removal.
+        #
+        order = numpy.argsort(ids, kind='mergesort')
+        ids, lats, lons = ids[order], lats[order], lons[order]
+        keep = numpy.append(ids[1:] != ids[:-1], True) & ~numpy.isnan(lats)
+        
+        self.ids, self.lats, self.lons = ids[keep], lats[keep], lons[keep]
+    
+    def __getstate__(self):
+        self._merge()
+        return dict(ids=self.ids, lats=self.lats, lons=self.lons)
+    
+    def __setstate__(self, state):
+        self.ids, self.lats, self.lons = state['ids'], state['lats'], state['lons']
+        self.chunks = []
+        self._reset()
+    
+    def __len__(self):
+        self._merge()
+        return len(self.ids)
+    
+    def __setitem__(self, id, (lat, lon)):
+        self.add(id, lat, lon)
+    
+    def add(self, id, lat, lon):
+        """ Add or move a node.
+        """
+        self.new_ids.append(id)
+        self.new_lats.append(lat)
+        self.new_lons.append(lon)
+        
+        if len(self.new_ids) >= 0x100000:
+            self._flush()
+    
+    def extend(self, ids, lats, lons):
+        """ Add or move nodes from arrays of ids, latitudes and longitudes.
+        """
+        if len(self.new_ids):
+            self._flush()
+        
+        if self.only is not None:
+            index = numpy.searchsorted(self.only, ids).clip(0, max(0, len(self.only) - 1))
+            wanted = self.only[index] == ids if len(self.only) else numpy.zeros(len(ids), dtype=bool)
+            ids, lats, lons = ids[wanted], lats[wanted], lons[wanted]
+        
+        if len(ids):
+            self.chunks.append((numpy.asarray(ids, dtype=numpy.int64), lats, lons))
+    
+    def remove(self, id):
+        """ Remove a node, if it's present.
+        """
+        self.add(id, numpy.nan, numpy.nan)
+    
+    def locations(self, ids):
+        """ Look up a list or array of node ids all at once.
+            
+            Return arrays of latitudes and longitudes, and a boolean
+            array that is false for missing nodes. Locations of missing
+            nodes are meaningless.
+        """
+        self._merge()
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        
+        if not len(self.ids):
+            return numpy.zeros(len(ids)), numpy.zeros(len(ids)), numpy.zeros(len(ids), dtype=bool)
+        
+        index = numpy.searchsorted(self.ids, ids).clip(0, len(self.ids) - 1)
+        
+        return self.lats[index], self.lons[index], self.ids[index] == ids
+
+def _filter_way_nodes(ways, nodes):
+    """ Remove ids of nodes missing from a NodeStore from a list of ways.
+        
+        Used by ParserOSM.parse(), so that way node references
+        need not be checked one at a time while parsing.
+    """
+    ways = [way for way in ways if len(way['nodes'])]
+    
+    if not ways:
+        return
     
-    return rel_ways, nodes
+    lats, lons, found = nodes.locations(numpy.concatenate([way['nodes'] for way in ways]))
+    
+    if found.all():
+        return
+    
+    offsets = numpy.cumsum([len(way['nodes']) for way in ways])
+    
+    for (way, way_found) in zip(ways, numpy.split(found, offsets[:-1])):
+        if not way_found.all():
+            way['nodes'] = way['nodes'][way_found]
+
+def _used_node_ids(ways, rels):
+    """ Return a sorted array of ids of nodes used by ways.
+        
+        Used by ParserOSM.parse() between two passes. If there are any
+        relations, only ways reachable from flattened_relations() are
+        counted, since other ways are never used for route relations.
+    """
+    if rels:
+        way_ids = set()
+        
+        for (key, rel_way_ids, rel_ids) in flattened_relations(rels).values():
+            way_ids.update(rel_way_ids)
+        
+        ways = dict([(way_id, ways[way_id]) for way_id in way_ids if way_id in ways])
+    
+    way_nodes = [way['nodes'] for way in ways.values()]
+    
+    return numpy.unique(numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + way_nodes))
 
 class ParserOSM:
 
@@ -182,8 +578,18 @@ class ParserOSM:
     rel = None
     way_key = None
     rel_key = None
-
-    def __init__(self):
+    skip_nodes = False
+    
+    def __init__(self, two_pass=False):
+        """ Create a new parser, optionally reading input twice.
+            
+            With two_pass set, the first pass over the input collects ways
+            and relations but skips nodes, and the second pass keeps only
+            nodes used by those ways, or just by ways in relations if there
+            are any relations. This uses memory in proportion to the
+            ways kept rather than the whole input, but input must be seekable.
+        """
+        self.two_pass = two_pass
         self.p = ParserCreate()
         self.p.StartElementHandler = self.start_element
         self.p.EndElementHandler = self.end_element
@@ -193,18 +599,41 @@ class ParserOSM:
         """ Given a file-like stream of OSM XML data, return dictionaries of ways and nodes.
         
             Keys are generated from way tags based on the way_key and ref_key arguments.
+            Nodes are returned in a NodeStore, and way nodes are int64 arrays of ids.
         """
-        self.nodes = dict()
+        self.nodes = NodeStore()
         self.ways = dict()
         self.rels = dict()
         self.way_key = way_key
         self.rel_key = rel_key
+        self.skip_nodes = self.two_pass
         self.p.ParseFile(input)
+        
+        if self.two_pass:
+            node_ids = _used_node_ids(self.ways, self.rels)
+            
+            debug('%d ways and %d relations use %d nodes, reading input again' % (len(self.ways), len(self.rels), len(node_ids)))
+            
+            self.nodes = NodeStore(node_ids)
+            self.skip_nodes = False
+            
+            input.seek(0)
+            p = ParserCreate()
+            p.StartElementHandler = self.start_node
+            p.ParseFile(input)
+        
+        _filter_way_nodes(self.ways.values(), self.nodes)
+        
         return self.rels, self.ways, self.nodes
     
-    def start_element(self, name, attrs):
+    def start_node(self, name, attrs):
         if name == 'node':
             self.add_node(attrs['id'], float(attrs['lat']), float(attrs['lon']))
+    
+    def start_element(self, name, attrs):
+        if name == 'node':
+            if not self.skip_nodes:
+                self.add_node(attrs['id'], float(attrs['lat']), float(attrs['lon']))
         
         elif name == 'way':
             self.add_way(attrs['id'])
@@ -212,7 +641,7 @@ class ParserOSM:
         elif name == 'tag' and self.way:
             self.tag_way(attrs['k'], attrs['v'])
         
-        elif name == 'nd' and attrs['ref'] in self.nodes and self.way:
+        elif name == 'nd' and self.way:
             self.extend_way(attrs['ref'])
         
         elif name == 'relation':
@@ -236,7 +665,7 @@ class ParserOSM:
             self.end_relation()
 
     def add_node(self, id, lat, lon):
-        self.nodes[id] = lat, lon
+        self.nodes.add(int(id), lat, lon)
     
     def add_way(self, id):
         self.way = id
@@ -248,7 +677,7 @@ class ParserOSM:
     
     def extend_way(self, id):
         way = self.ways[self.way]
-        way['nodes'].append(id)
+        way['nodes'].append(int(id))
     
     def end_way(self):
         way = self.ways[self.way]
@@ -256,6 +685,7 @@ class ParserOSM:
         
         if key:
             way['key'] = key
+            way['nodes'] = numpy.array(way['nodes'], dtype=numpy.int64)
             del way['tags']
 
         else:
@@ -287,3 +717,184 @@ class ParserOSM:
             del self.rels[self.rel]
         
         self.rel = None
+
+class ParserPBF (ParserOSM):
+    """ Parser for OSM PBF files, with the same results as ParserOSM.
+        
+        http://wiki.openstreetmap.org/wiki/PBF_Format
+    """
+    def __init__(self, two_pass=False, workers=1):
+        """ Create a new parser, optionally decoding blocks in a pool of processes.
+            
+            With workers more than one, blocks of input are decompressed
+            and decoded by pbf.decode_block() in that many processes, and
+            their contents added here in their original order. See
+            ParserOSM for two_pass.
+        """
+        ParserOSM.__init__(self, two_pass)
+        self.workers = workers
+    
+    def parse(self, input, way_key=lambda tags: None, rel_key=lambda tags: None):
+        """ Given a file-like stream of OSM PBF data, return dictionaries of ways and nodes.
+            
+            Arguments and results are the same as ParserOSM.parse().
+        """
+        self.nodes = NodeStore()
+        self.ways = dict()
+        self.rels = dict()
+        self.way_key = way_key
+        self.rel_key = rel_key
+        
+        pool = self.workers > 1 and Pool(self.workers) or None
+        
+        try:
+            self.read_blocks(input, pool, not self.two_pass, True)
+            
+            if self.two_pass:
+                node_ids = _used_node_ids(self.ways, self.rels)
+                
+                debug('%d ways and %d relations use %d nodes, reading input again' % (len(self.ways), len(self.rels), len(node_ids)))
+                
+                self.nodes = NodeStore(node_ids)
+                
+                input.seek(0)
+                self.read_blocks(input, pool, True, False)
+        
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        
+        _filter_way_nodes(self.ways.values(), self.nodes)
+        
+        return self.rels, self.ways, self.nodes
+    
+    def read_blocks(self, input, pool, read_nodes, read_others):
+        """ Decode every block of input and add its contents.
+            
+            Blobs are read a few per worker at a time, so that
+            a large file is never held in memory all at once.
+        """
+        blobs = read_blobs(input)
+        batch_size = pool and 4 * self.workers or 1
+        
+        while True:
+            batch, args = list(islice(blobs, batch_size)), []
+            
+            if not batch:
+                break
+            
+            for (type, blob) in batch:
+                if type == 'OSMHeader':
+                    check_header(blob)
+                
+                elif type == 'OSMData':
+                    args.append((blob, read_nodes, read_others))
+            
+            for (nodes, ways, rels) in (pool and pool.imap(decode_block, args) or imap(decode_block, args)):
+                self.add_block(nodes, ways, rels)
+    
+    def add_block(self, (node_ids, node_lats, node_lons), ways, rels):
+        """ Add nodes, ways and relations from pbf.decode_block().
+        """
+        self.nodes.extend(node_ids, node_lats, node_lons)
+        
+        for (id, tags, node_ids) in ways:
+            self.add_way(id)
+            self.ways[id]['tags'] = tags
+            self.ways[id]['nodes'] = node_ids
+            self.end_way()
+        
+        for (id, tags, members) in rels:
+            self.add_relation(id)
+            self.rels[id]['tags'] = tags
+            
+            for (type, ref) in members:
+                if type == 'way' and ref in self.ways:
+                    self.extend_relation(ref, 'way')
+                
+                elif type == 'rel':
+                    self.extend_relation(ref, 'rel')
+            
+            self.end_relation()
+
+class ParserOSC (ParserOSM):
+    """ Parser for osmChange files, applied on top of ParserOSM results.
+        
+        http://wiki.openstreetmap.org/wiki/OsmChange
+    """
+    action = None
+    changed_nodes = None
+    old_rels = None
+    old_ways = None
+    
+    def __init__(self, rels, ways, nodes):
+        ParserOSM.__init__(self)
+        self.rels, self.ways, self.nodes = rels, ways, nodes
+    
+    def parse(self, input, way_key=lambda tags: None, rel_key=lambda tags: None):
+        """ Given a file-like stream of osmChange data, update relations, ways and nodes.
+            
+            Return dictionaries of previous relations and ways for each one
+            that was created, modified or deleted, or that uses a modified
+            or deleted node. Previous values are None for new ones.
+        """
+        self.changed_nodes = set()
+        self.old_rels = dict()
+        self.old_ways = dict()
+        self.way_key = way_key
+        self.rel_key = rel_key
+        self.p.ParseFile(input)
+        
+        #
+        # Ways using any changed nodes have changed too,
+        # and lose any of their nodes that were deleted.
+        #
+        way_ids = [way_id for (way_id, way) in self.ways.items() if len(way['nodes'])]
+        
+        if way_ids and self.changed_nodes:
+            way_nodes = [self.ways[way_id]['nodes'] for way_id in way_ids]
+            owners = numpy.repeat(numpy.arange(len(way_ids)), map(len, way_nodes))
+            changed = numpy.in1d(numpy.concatenate(way_nodes), list(self.changed_nodes))
+            
+            for index in numpy.unique(owners[changed]):
+                if way_ids[index] not in self.old_ways:
+                    self.old_ways[way_ids[index]] = dict(self.ways[way_ids[index]])
+        
+        changed_ways = [self.ways[way_id] for way_id in self.old_ways if way_id in self.ways]
+        _filter_way_nodes(changed_ways, self.nodes)
+        
+        return self.old_rels, self.old_ways
+    
+    def start_element(self, name, attrs):
+        if name in ('create', 'modify', 'delete'):
+            self.action = name
+            return
+        
+        if name == 'node':
+            self.changed_nodes.add(int(attrs['id']))
+        
+        elif name == 'way' and attrs['id'] not in self.old_ways:
+            self.old_ways[attrs['id']] = self.ways.get(attrs['id'], None)
+        
+        elif name == 'relation' and attrs['id'] not in self.old_rels:
+            self.old_rels[attrs['id']] = self.rels.get(attrs['id'], None)
+        
+        if self.action != 'delete':
+            ParserOSM.start_element(self, name, attrs)
+        
+        elif name == 'node':
+            self.nodes.remove(int(attrs['id']))
+        
+        elif name == 'way':
+            self.ways.pop(attrs['id'], None)
+        
+        elif name == 'relation':
+            self.rels.pop(attrs['id'], None)
+    
+    def end_element(self, name):
+        if name in ('create', 'modify', 'delete'):
+            self.action = None
+        
+        elif self.action != 'delete':
+            ParserOSM.end_element(self, name)
@@ -1,19 +1,115 @@
 from pickle import dumps as pickleit
+from multiprocessing import Pool
+from itertools import imap, izip
 from tempfile import mkstemp
 from os import write, close
 from json import dumps
 
 import logging
 
+import numpy
+
 from shapely.geometry import LineString, MultiLineString, asShape
 
-from . import multigeom_centerline, mercator, _GraphRoutesOvertime, projected_multigeometry
+from . import multigeom_centerline, mercator_lines, _GraphRoutesOvertime, projected_multigeometry, simplified_multiline
 from .util import zoom_buffer
 
-def generalize_geojson_feature(feature, width, zoom):
+_geometry_depths = dict(Point=0, LineString=1, MultiPoint=1, Polygon=2, MultiLineString=2, MultiPolygon=3)
+
+def _encode_coordinates(coordinates, depth, precision):
+    ''' Encode nested GeoJSON coordinates as JSON text at a fixed precision.
+    
+        Whole arrays of positions are formatted with a single string
+        formatting operation, rather than one number at a time.
+    '''
+    if depth > 1:
+        return '[%s]' % ','.join([_encode_coordinates(part, depth - 1, precision) for part in coordinates])
+    
+    positions = numpy.asarray(coordinates, dtype=float)
+    
+    if depth == 0:
+        positions = positions.reshape(1, -1)
+    
+    if positions.size == 0:
+        return '[]'
+    
+    number = '%%.%df' % precision
+    position = '[' + ','.join([number] * positions.shape[1]) + ']'
+    encoded = ','.join([position] * positions.shape[0]) % tuple(positions.ravel().tolist())
+    
+    return encoded[1:-1] if depth == 0 else '[%s]' % encoded
+
+def encode_geometry(geometry, precision=5):
+    ''' Encode a GeoJSON geometry dictionary as JSON text at a fixed precision.
+    '''
+    if geometry is None:
+        return 'null'
+    
+    if geometry['type'] == 'GeometryCollection':
+        parts = [encode_geometry(part, precision) for part in geometry['geometries']]
+        return '{"type":"GeometryCollection","geometries":[%s]}' % ','.join(parts)
+    
+    depth = _geometry_depths[geometry['type']]
+    coordinates = _encode_coordinates(geometry['coordinates'], depth, precision)
+    
+    return '{"type":%s,"coordinates":%s}' % (dumps(geometry['type']), coordinates)
+
+def encode_feature(feature, precision=5):
+    ''' Encode a GeoJSON feature dictionary as JSON text at a fixed precision.
+    
+        Only geometry coordinates are rounded, properties are left as-is.
+    '''
+    encoded = ['{"type":"Feature"']
+    
+    if 'id' in feature:
+        encoded.append(',"id":' + dumps(feature['id']))
+    
+    encoded.append(',"properties":' + dumps(feature.get('properties'), separators=(',', ':')))
+    encoded.append(',"geometry":' + encode_geometry(feature.get('geometry'), precision) + '}')
+    
+    return ''.join(encoded)
+
+class GeoJSONWriter:
+    ''' Streaming writer of GeoJSON features at a fixed coordinate precision.
+    
+        Features are written one at a time, either to a FeatureCollection
+        or with format "seq" to newline-delimited GeoJSON. Call close()
+        when done to finish the FeatureCollection and close the output.
+    '''
+    def __init__(self, output, precision=5, format='collection'):
+        if format not in ('collection', 'seq'):
+            raise ValueError('Unknown GeoJSON format "%s"' % format)
+        
+        self.output = output
+        self.precision = precision
+        self.format = format
+        self.count = 0
+        
+        if self.format == 'collection':
+            self.output.write('{"type":"FeatureCollection","features":[')
+    
+    def write(self, feature):
+        encoded = encode_feature(feature, self.precision)
+        
+        if self.format == 'seq':
+            self.output.write(encoded + '\n')
+        else:
+            self.output.write((self.count and ',' or '') + encoded)
+        
+        self.count += 1
+    
+    def close(self):
+        if self.format == 'collection':
+            self.output.write(']}')
+        
+        self.output.close()
+
+def generalize_geojson_feature(feature, width, zoom, pool=None, cache=None):
     ''' Run one GeoJSON feature through Skeletron and return it.
     
-        If generalization fails, return False.
+        If generalization fails, return False. Optional pool is passed
+        to multigeom_centerline() to generalize parts concurrently,
+        and optional cache is a cache.Cache for reusing past results.
     '''
     prop = dict([(k.lower(), v) for (k, v) in feature['properties'].items()])
     name = prop.get('name', prop.get('id', prop.get('gid', prop.get('fid', None))))
@@ -25,7 +121,7 @@ def generalize_geojson_feature(feature, width, zoom):
     logging.info('Generalizing %s, %d wkb, %.1f buffer' % (dumps(name), len(geom.wkb), buffer))
     
     multigeom = projected_multigeometry(geom)
-    generalized = generalized_multiline(multigeom, **kwargs)
+    generalized = generalized_multiline(multigeom, pool=pool, cache=cache, **kwargs)
     
     if generalized is None:
         return False
@@ -34,10 +130,12 @@ def generalize_geojson_feature(feature, width, zoom):
     
     return feature
 
-def generalize_geometry(geometry, width, zoom):
+def generalize_geometry(geometry, width, zoom, pool=None, cache=None):
     ''' Run one geometry through Skeletron and return it.
     
-        If generalization fails, return False.
+        If generalization fails, return False. Optional pool is passed
+        to multigeom_centerline() to generalize parts concurrently,
+        and optional cache is a cache.Cache for reusing past results.
     '''
     buffer = zoom_buffer(width, zoom)
     kwargs = dict(buffer=buffer, density=buffer/2, min_length=8*buffer, min_area=(buffer**2)/4)
@@ -45,55 +143,185 @@ def generalize_geometry(geometry, width, zoom):
     logging.debug('Generalizing %s, %d wkb, %.1f buffer' % (geometry.type, len(geometry.wkb), buffer))
     
     multigeom = projected_multigeometry(geometry)
-    generalized = generalized_multiline(multigeom, **kwargs)
+    generalized = generalized_multiline(multigeom, pool=pool, cache=cache, **kwargs)
     
     if generalized is None:
         return False
     
     return generalized
 
-def multilines_geojson(multilines, key_properties, buffer, density, min_length, min_area):
-    """
-    """
-    geojson = dict(type='FeatureCollection', features=[])
-
-    for (key, multiline) in sorted(multilines.items()):
+def generalize_geometry_zooms(geometry, width, zooms, pool=None, cache=None):
+    ''' Run one geometry through Skeletron at several zoom levels.
+        
+        Return a dictionary of generalized geometries keyed on zoom,
+        with False for any zoom where generalization fails.
+        
+        The geometry is projected just once. Zooms are handled from highest
+        to lowest, and for lines each zoom starts from the previous zoom's
+        input after a light Douglas-Peucker pass at one eighth of its own
+        buffer. That tolerance is well under the full-buffer simplification
+        done in multigeom_centerline(), so long raw lines are only simplified
+        in full once. Polygons are never simplified and are reused as-is.
+    '''
+    multigeom = projected_multigeometry(geometry)
+    generalized = dict()
+    
+    for zoom in sorted(set(zooms), reverse=True):
+        buffer = zoom_buffer(width, zoom)
+        kwargs = dict(buffer=buffer, density=buffer/2, min_length=8*buffer, min_area=(buffer**2)/4)
+        
+        logging.debug('Generalizing %s, zoom %d, %.1f buffer' % (geometry.type, zoom, buffer))
         
-        logging.info('%s...' % ', '.join([(p or '').encode('ascii', 'ignore') for p in key]))
+        if generalized and multigeom.type == 'MultiLineString':
+            # Not the first zoom, so reuse the previous input.
+            multigeom = simplified_multiline(multigeom, buffer/8)
         
         try:
-            centerline = multigeom_centerline(multiline, buffer, density, min_length, min_area)
-        
-        except _GraphRoutesOvertime, e:
-            #
-            # Catch overtimes here because they seem to affect larger networks
-            # and therefore most or all of a complex multiline. We'll keep the
-            # key and a pickled copy of the offending graph.
-            #
-            logging.error('Graph routes went overtime')
-            
-            handle, fname = mkstemp(dir='.', prefix='graph-overtime-', suffix='.txt')
-            write(handle, repr(key) + '\n' + pickleit(e.graph))
-            close(handle)
-            continue
+            generalized[zoom] = generalized_multiline(multigeom, pool=pool, cache=cache, **kwargs) or False
         
-        if not centerline:
+        except Exception, e:
+            logging.error('Error at zoom %d: %s' % (zoom, e))
+            generalized[zoom] = False
+    
+    return generalized
+
+def generalize_geojson_feature_zooms(feature, width, zooms, pool=None, cache=None):
+    ''' Run one GeoJSON feature through Skeletron at several zoom levels.
+        
+        Return a list of new features with a "zoomlevel" property, one
+        for each zoom where generalization succeeds, highest zoom first.
+        See generalize_geometry_zooms().
+    '''
+    prop = dict([(k.lower(), v) for (k, v) in feature['properties'].items()])
+    name = prop.get('name', prop.get('id', prop.get('gid', prop.get('fid', None))))
+    geom = asShape(feature['geometry'])
+    
+    logging.info('Generalizing %s, %d wkb, zooms %s' % (dumps(name), len(geom.wkb), ', '.join(map(str, zooms))))
+    
+    generalized = generalize_geometry_zooms(geom, width, zooms, pool, cache)
+    features = []
+    
+    for (zoom, geometry) in sorted(generalized.items(), reverse=True):
+        if not geometry:
             continue
         
-        for geom in centerline.geoms:
-            coords = [mercator(*point, inverse=True) for point in geom.coords]
-            geometry = LineString(coords).__geo_interface__
-            feature = dict(geometry=geometry, properties=key_properties(key))
+        properties = dict(feature['properties'], zoomlevel=zoom)
+        features.append(dict(type='Feature', properties=properties, geometry=geometry.__geo_interface__))
+    
+    return features
+
+def _multiline_centerline(args):
+    ''' Find a centerline for multilines_geojson(), possibly in a worker process.
+    
+        Return a centerline and None, or None and a pickled copy of the
+        offending graph if graph routes went overtime.
+    '''
+    multiline, buffer, density, min_length, min_area = args
+    
+    try:
+        return multigeom_centerline(multiline, buffer, density, min_length, min_area), None
+    
+    except _GraphRoutesOvertime, e:
+        return None, pickleit(e.graph)
+
+def multilines_geojson(multilines, key_properties, buffer, density, min_length, min_area, workers=1, cache=None):
+    """ Return a GeoJSON FeatureCollection of centerlines for a dictionary of multilines.
+    
+        Keys are processed in sorted order, and the workers argument
+        optionally fans them out to a pool of processes. Output order is
+        the same either way.
+        
+        Optional cache is a cache.Cache, checked in this process so that
+        only uncached multilines are handed out to workers.
+    """
+    geojson = dict(type='FeatureCollection', features=[])
+    
+    items = sorted(multilines.items())
+    
+    if cache:
+        cache_keys = [cache.key(multiline, buffer, density, min_length, min_area, None, 'astar') for (key, multiline) in items]
+        cached = map(cache.get, cache_keys)
+    else:
+        cache_keys, cached = [None] * len(items), [None] * len(items)
+    
+    args = [(multiline, buffer, density, min_length, min_area)
+            for ((key, multiline), centerline) in izip(items, cached) if centerline is None]
+    
+    if workers > 1:
+        pool = Pool(workers)
+        results = pool.imap(_multiline_centerline, args)
+    else:
+        pool = None
+        results = imap(_multiline_centerline, args)
 
-            geojson['features'].append(feature)
+    try:
+        for ((key, multiline), cache_key, centerline) in izip(items, cache_keys, cached):
+            
+            if centerline is None:
+                centerline, overtime = results.next()
+                
+                if cache and not overtime:
+                    cache.put(cache_key, centerline)
+            else:
+                overtime = None
+            
+            logging.info('%s...' % ', '.join([(p or '').encode('ascii', 'ignore') for p in key]))
+            
+            if overtime:
+                #
+                # Catch overtimes here because they seem to affect larger networks
+                # and therefore most or all of a complex multiline. We'll keep the
+                # key and a pickled copy of the offending graph.
+                #
+                logging.error('Graph routes went overtime')
+                
+                handle, fname = mkstemp(dir='.', prefix='graph-overtime-', suffix='.txt')
+                write(handle, repr(key) + '\n' + overtime)
+                close(handle)
+                continue
+            
+            if not centerline:
+                continue
+            
+            lines = [geom.coords for geom in centerline.geoms]
+            
+            for coords in mercator_lines(lines, inverse=True):
+                geometry = LineString(coords).__geo_interface__
+                feature = dict(geometry=geometry, properties=key_properties(key))
+
+                geojson['features'].append(feature)
+    
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
     return geojson
 
-def generalized_multiline(multiline, buffer, density, min_length, min_area):
+def update_multilines_geojson(geojson, multilines, keys, key_properties, buffer, density, min_length, min_area, workers=1, cache=None):
+    """ Return a copy of a FeatureCollection from multilines_geojson() with some keys regenerated.
+        
+        Features for each of the given keys are found by their properties
+        from key_properties() and removed, and new centerlines for any of
+        those keys still in multilines are added at the end. Other features
+        are left untouched, so multilines only needs to hold changed keys.
+    """
+    stale = set([frozenset(key_properties(key).items()) for key in keys])
+    features = [feature for feature in geojson['features']
+                if frozenset(feature['properties'].items()) not in stale]
+    
+    multilines = dict([(key, multilines[key]) for key in keys if key in multilines])
+    fresh = multilines_geojson(multilines, key_properties, buffer, density, min_length, min_area, workers, cache)
+    
+    logging.info('Replaced %d features with %d for %d keys' % (len(geojson['features']) - len(features), len(fresh['features']), len(keys)))
+    
+    return dict(geojson, features=features + fresh['features'])
+
+def generalized_multiline(multiline, buffer, density, min_length, min_area, pool=None, cache=None):
     '''
     '''
     try:
-        centerline = multigeom_centerline(multiline, buffer, density, min_length, min_area)
+        centerline = multigeom_centerline(multiline, buffer, density, min_length, min_area, pool=pool, cache=cache)
     
     except Exception, e:
         raise
@@ -103,7 +331,7 @@ def generalized_multiline(multiline, buffer, density, min_length, min_area):
     if not centerline:
         return None
         
-    coords = [[mercator(x, y, inverse=True) for (x, y) in line.coords] for line in centerline]
-    geographic = MultiLineString(coords)
+    lines = [line.coords for line in centerline.geoms]
+    geographic = MultiLineString(mercator_lines(lines, inverse=True))
     
     return geographic
@@ -0,0 +1,267 @@
+""" Reader for OpenStreetMap PBF input.
+
+PBF is a sequence of independently-compressed blobs, each holding a block
+of nodes, ways or relations: http://wiki.openstreetmap.org/wiki/PBF_Format
+
+Protocol buffer messages are decoded by hand here, with no dependency on
+a protobuf library. Packed arrays of numbers, where most of the bytes in
+a file go, are decoded with NumPy. Because blocks don't depend on one
+another, blobs can be decompressed and decoded in a pool of processes.
+See input.ParserPBF for a parser built on decode_block().
+"""
+from struct import unpack
+from zlib import decompress
+
+import numpy
+
+class _PBFFailure (Exception): pass
+
+_supported_features = ('OsmSchema-V0.6', 'DenseNodes')
+
+_member_types = {0: 'node', 1: 'way', 2: 'rel'}
+
+def _varint(data, offset):
+    """ Return a varint from a string of data and the offset just past it.
+    """
+    value, shift = 0, 0
+    
+    while True:
+        byte = ord(data[offset])
+        value |= (byte & 0x7f) << shift
+        offset += 1
+        
+        if byte < 0x80:
+            return value, offset
+        
+        shift += 7
+
+def _int64(value):
+    """ Return a signed int64 from an unsigned varint, by two's complement.
+    """
+    return value - 0x10000000000000000 if value & 0x8000000000000000 else value
+
+def _fields(data):
+    """ Generate (field number, value) pairs for a protocol buffer message.
+        
+        Values are numbers for varint fields and strings for length-delimited
+        fields like strings, embedded messages and packed arrays. Fixed-width
+        fields aren't used by PBF and are skipped.
+    """
+    offset, length = 0, len(data)
+    
+    while offset < length:
+        key, offset = _varint(data, offset)
+        number, wire_type = key >> 3, key & 0x07
+        
+        if wire_type == 0:
+            value, offset = _varint(data, offset)
+        
+        elif wire_type == 2:
+            size, offset = _varint(data, offset)
+            value, offset = data[offset:offset+size], offset + size
+        
+        elif wire_type == 1:
+            offset += 8
+            continue
+        
+        elif wire_type == 5:
+            offset += 4
+            continue
+        
+        else:
+            raise _PBFFailure('Unknown wire type %d' % wire_type)
+        
+        yield number, value
+
+def _packed(data):
+    """ Return a uint64 array of the varints in a packed array.
+        
+        Every byte with its high bit clear ends a varint, so each byte's
+        place can be found without stepping through them one at a time.
+    """
+    bytes = numpy.frombuffer(data, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(bytes < 0x80)
+    
+    if not len(ends):
+        return numpy.zeros(0, dtype=numpy.uint64)
+    
+    starts = numpy.append(0, ends[:-1] + 1)
+    owners = numpy.repeat(numpy.arange(len(ends)), ends - starts + 1)
+    shifts = (numpy.arange(len(bytes)) - starts[owners]) * 7
+    values = (bytes & 0x7f).astype(numpy.uint64) << shifts.astype(numpy.uint64)
+    
+    return numpy.add.reduceat(values, starts)
+
+def _zigzag(values):
+    """ Return an int64 array of signed values from a uint64 array of sint64 varints.
+    """
+    return (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+
+def _packed_pieces(pieces):
+    """ Decode a list of packed arrays all at once, return values and offsets.
+        
+        Values of piece i are values[offsets[i]:offsets[i+1]]. One call here
+        is much quicker than a call to _packed() for each of many small ways.
+    """
+    data = ''.join(pieces)
+    ended = numpy.append(0, numpy.cumsum(numpy.frombuffer(data, dtype=numpy.uint8) < 0x80))
+    offsets = ended[numpy.append(0, numpy.cumsum(map(len, pieces)))]
+    
+    return _packed(data), offsets
+
+def _split_deltas(pieces):
+    """ Return a list of int64 arrays for a list of packed delta-coded sint64 arrays.
+    """
+    values, offsets = _packed_pieces(pieces)
+    sums = numpy.cumsum(_zigzag(values))
+    
+    # Deltas start over at the beginning of each piece.
+    sums -= numpy.repeat(numpy.append(0, sums)[offsets[:-1]], numpy.diff(offsets))
+    
+    return numpy.split(sums, offsets[1:-1])
+
+def _split_tags(key_pieces, value_pieces, strings):
+    """ Return a list of tag dictionaries for lists of packed string table indexes.
+    """
+    keys, offsets = _packed_pieces(key_pieces)
+    values = _packed_pieces(value_pieces)[0]
+    keys, values = [strings[i] for i in keys.tolist()], [strings[i] for i in values.tolist()]
+    offsets = offsets.tolist()
+    
+    return [dict(zip(keys[start:end], values[start:end])) for (start, end) in zip(offsets[:-1], offsets[1:])]
+
+def read_blobs(input):
+    """ Generate (type, blob) pairs from a file-like stream of PBF data.
+        
+        Blob messages are returned still compressed, to be decoded
+        by decode_blob() elsewhere.
+    """
+    while True:
+        head = input.read(4)
+        
+        if not head:
+            break
+        
+        if len(head) < 4:
+            raise _PBFFailure('Truncated blob header length')
+        
+        header = dict(_fields(input.read(unpack('>I', head)[0])))
+        blob = input.read(header.get(3, 0))
+        
+        if len(blob) < header.get(3, 0):
+            raise _PBFFailure('Truncated blob')
+        
+        yield header.get(1, ''), blob
+
+def decode_blob(blob):
+    """ Return uncompressed data from a Blob message.
+    """
+    fields = dict(_fields(blob))
+    
+    if 1 in fields:
+        return fields[1]
+    
+    if 3 in fields:
+        return decompress(fields[3])
+    
+    raise _PBFFailure('Unsupported blob compression')
+
+def check_header(blob):
+    """ Raise an exception if a HeaderBlock requires unsupported features.
+    """
+    for (number, value) in _fields(decode_blob(blob)):
+        if number == 4 and value not in _supported_features:
+            raise _PBFFailure('Unsupported required feature "%s"' % value)
+
+def decode_block((blob, read_nodes, read_others)):
+    """ Decode a PrimitiveBlock from a Blob message, return nodes, ways and relations.
+        
+        Nodes are a tuple of id, latitude and longitude arrays.
+        Ways are a list of (id, tags, node id array) tuples.
+        Relations are a list of (id, tags, members) tuples, with members
+        given as a list of ('node', 'way' or 'rel', id) tuples.
+        
+        Ids of ways and relations are strings, as in ParserOSM.
+        Nodes are left out unless read_nodes is true,
+        and ways and relations unless read_others is true.
+    """
+    block = decode_blob(blob)
+    strings, groups = [], []
+    granularity, lat_offset, lon_offset = 100, 0, 0
+    
+    for (number, value) in _fields(block):
+        if number == 1:
+            strings = [string.decode('utf8') for (n, string) in _fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 19:
+            lat_offset = _int64(value)
+        elif number == 20:
+            lon_offset = _int64(value)
+    
+    ids, lats, lons = [numpy.zeros(0, dtype=numpy.int64)], [], []
+    way_fields, rel_fields = [], []
+    ways, rels = [], []
+    
+    for group in groups:
+        for (number, value) in _fields(group):
+            
+            if number == 1 and read_nodes:
+                #
+                # Plain nodes are rare, most writers use dense nodes.
+                #
+                fields = dict(_fields(value))
+                values = numpy.array([fields.get(1, 0), fields.get(8, 0), fields.get(9, 0)], dtype=numpy.uint64)
+                id, lat, lon = _zigzag(values)
+                
+                ids.append(numpy.array([id]))
+                lats.append(numpy.array([lat]))
+                lons.append(numpy.array([lon]))
+            
+            elif number == 2 and read_nodes:
+                fields = dict(_fields(value))
+                ids.append(numpy.cumsum(_zigzag(_packed(fields.get(1, '')))))
+                lats.append(numpy.cumsum(_zigzag(_packed(fields.get(8, '')))))
+                lons.append(numpy.cumsum(_zigzag(_packed(fields.get(9, '')))))
+            
+            elif number == 3 and read_others:
+                way_fields.append(dict(_fields(value)))
+            
+            elif number == 4 and read_others:
+                rel_fields.append(dict(_fields(value)))
+    
+    #
+    # Packed arrays of ways and relations are small, and decoded
+    # for all of a block at once to keep NumPy overhead down.
+    #
+    if way_fields:
+        way_ids = [str(_int64(fields.get(1, 0))) for fields in way_fields]
+        way_tags = _split_tags([fields.get(2, '') for fields in way_fields],
+                               [fields.get(3, '') for fields in way_fields], strings)
+        way_nodes = _split_deltas([fields.get(8, '') for fields in way_fields])
+        
+        ways = zip(way_ids, way_tags, way_nodes)
+    
+    if rel_fields:
+        rel_ids = [str(_int64(fields.get(1, 0))) for fields in rel_fields]
+        rel_tags = _split_tags([fields.get(2, '') for fields in rel_fields],
+                               [fields.get(3, '') for fields in rel_fields], strings)
+        member_ids = _split_deltas([fields.get(9, '') for fields in rel_fields])
+        member_types, offsets = _packed_pieces([fields.get(10, '') for fields in rel_fields])
+        member_types = [_member_types.get(type, None) for type in member_types.tolist()]
+        offsets = offsets.tolist()
+        
+        rels = [(id, tags, zip(member_types[start:end], map(str, refs.tolist())))
+                for (id, tags, refs, start, end) in zip(rel_ids, rel_tags, member_ids, offsets[:-1], offsets[1:])]
+    
+    #
+    # Coordinates are stored in units of granularity nanodegrees.
+    # Dividing exact integers here gives the same floats as parsing
+    # decimal degrees from OSM XML.
+    #
+    lats = (lat_offset + granularity * numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + lats)) / 1e9
+    lons = (lon_offset + granularity * numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + lons)) / 1e9
+    
+    return (numpy.concatenate(ids), lats, lons), ways, rels
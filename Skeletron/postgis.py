@@ -0,0 +1,209 @@
+""" PostGIS input and output for generalized features.
+
+postgis_features() streams GeoJSON-like features from a query through a
+server-side cursor, and PostGISWriter loads features into a table with
+binary COPY, so generalizing features kept in PostGIS doesn't need any
+intermediate files. Both take an open psycopg2 connection.
+
+Geometries are read and written in unprojected WGS84, SRID 4326, the
+same as GeoJSON input and output.
+"""
+from struct import pack, unpack
+from cStringIO import StringIO
+from decimal import Decimal
+from json import dumps
+
+from shapely.wkb import loads as wkb_decode
+from shapely.geometry import asShape
+
+_wkb_column = 'skeletron_wkb'
+
+def _quote_ident(name):
+    ''' Quote a possibly schema-qualified SQL identifier.
+    '''
+    return '.'.join(['"%s"' % part.replace('"', '""') for part in name.split('.')])
+
+def _property_value(value):
+    ''' Convert a database value to one that can be written out as JSON.
+    '''
+    if value is None or isinstance(value, (bool, int, long, float, basestring, dict, list)):
+        # includes json and jsonb values, already decoded by psycopg2
+        return value
+    
+    if isinstance(value, Decimal):
+        return float(value)
+    
+    return unicode(value)
+
+def postgis_features(conn, query, geometry_column='way', batch_size=1000):
+    ''' Generate features one at a time from the rows of a query.
+        
+        Geometry comes from the named geometry column, transformed to
+        SRID 4326, and properties from all the other columns. Rows are
+        fetched batch_size at a time through a server-side cursor.
+        
+        Text comes back as UTF-8, and the connection's client encoding
+        is set to UTF8 if it isn't already.
+    '''
+    if conn.encoding != 'UTF8':
+        conn.set_client_encoding('UTF8')
+    
+    db = conn.cursor('skeletron_features')
+    db.itersize = batch_size
+    
+    db.execute('SELECT q.*, ST_AsBinary(ST_Transform(q.%s, 4326)) AS %s FROM (%s) AS q'
+               % (_quote_ident(geometry_column), _wkb_column, query))
+    
+    names = None
+    
+    for row in db:
+        if names is None:
+            # Server-side cursors have no description until the first fetch.
+            names = [column[0] for column in db.description]
+        
+        values = dict(zip(names, row))
+        wkb = values.pop(_wkb_column)
+        
+        del values[geometry_column]
+        
+        properties = dict([(name, _property_value(value)) for (name, value) in values.items()])
+        geometry = wkb and wkb_decode(str(wkb)).__geo_interface__
+        
+        yield dict(type='Feature', geometry=geometry, properties=properties)
+    
+    db.close()
+
+def _encode_ewkb(geometry, srid):
+    ''' Return EWKB for a shapely geometry, with an SRID.
+    '''
+    wkb = geometry.wkb
+    order = wkb[0] == '\x01' and '<' or '>'
+    type, = unpack(order + 'I', wkb[1:5])
+    
+    return wkb[0] + pack(order + 'II', type | 0x20000000, srid) + wkb[5:]
+
+def _encode_text(value):
+    if isinstance(value, str):
+        return value
+    
+    return unicode(value).encode('utf8')
+
+def _encode_json(value):
+    return dumps(value)
+
+#
+# Encoders from Python values to PostgreSQL binary COPY fields, by column type.
+# http://www.postgresql.org/docs/current/static/sql-copy.html#AEN66797
+#
+_binary_encoders = {
+    'text': _encode_text,
+    'character varying': _encode_text,
+    'json': _encode_json,
+    'jsonb': lambda value: '\x01' + _encode_json(value),
+    'smallint': lambda value: pack('>h', int(value)),
+    'integer': lambda value: pack('>i', int(value)),
+    'bigint': lambda value: pack('>q', int(value)),
+    'real': lambda value: pack('>f', float(value)),
+    'double precision': lambda value: pack('>d', float(value)),
+    'boolean': lambda value: value and '\x01' or '\x00'
+    }
+
+class PostGISWriter:
+    ''' Streaming writer of features to a PostGIS table with binary COPY.
+        
+        Geometries go to geometry_column as SRID 4326, and properties to
+        columns of the same name; properties without a matching column
+        are left out. Supported column types are text, character varying,
+        json, jsonb, smallint, integer, bigint, real, double precision and
+        boolean. Columns with defaults, such as serial ids, are left for
+        the database to fill in. Features are copied batch_size at a time,
+        and close() copies any remaining features and commits.
+        
+        write() raises ValueError for a property that can't be converted
+        to its column's type, before anything of that feature is copied.
+        The connection's client encoding is set to UTF8 if it isn't already.
+    '''
+    def __init__(self, conn, table, geometry_column='way', batch_size=1000):
+        self.conn = conn
+        self.table = table
+        self.geometry_column = geometry_column
+        self.batch_size = batch_size
+        self.count = 0
+        self.rows = []
+        
+        if conn.encoding != 'UTF8':
+            # Text fields are encoded here as UTF-8, so tell the server.
+            conn.set_client_encoding('UTF8')
+        
+        db = conn.cursor()
+        
+        db.execute('''SELECT attname, atttypid::regtype::text
+                      FROM pg_attribute
+                      WHERE attrelid = %s::regclass
+                        AND attnum > 0 AND NOT attisdropped
+                        AND NOT atthasdef AND attidentity = ''
+                      ORDER BY attnum''',
+                   (_quote_ident(table), ))
+        
+        columns = [(name, type) for (name, type) in db.fetchall()
+                   if name == geometry_column or type in _binary_encoders]
+        
+        if geometry_column not in [name for (name, type) in columns]:
+            raise ValueError('Table %s has no column "%s"' % (table, geometry_column))
+        
+        self.columns = columns
+    
+    def _encode_row(self, feature):
+        ''' Return a binary COPY tuple for a feature.
+        '''
+        fields = [pack('>h', len(self.columns))]
+        properties = feature.get('properties') or dict()
+        
+        for (name, type) in self.columns:
+            if name == self.geometry_column:
+                value = feature.get('geometry') and _encode_ewkb(asShape(feature['geometry']), 4326) or None
+            
+            elif properties.get(name, None) is None:
+                value = None
+            
+            else:
+                try:
+                    value = _binary_encoders[type](properties[name])
+                except (TypeError, ValueError, UnicodeError), e:
+                    raise ValueError('Property "%s" doesn\'t fit %s column: %s' % (name, type, e))
+            
+            if value is None:
+                fields.append(pack('>i', -1))
+            else:
+                fields.append(pack('>i', len(value)) + value)
+        
+        return ''.join(fields)
+    
+    def write(self, feature):
+        self.rows.append(self._encode_row(feature))
+        self.count += 1
+        
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        ''' Copy any waiting features to the table.
+        '''
+        if not self.rows:
+            return
+        
+        data = StringIO()
+        data.write('PGCOPY\n\xff\r\n\x00' + pack('>ii', 0, 0))
+        data.write(''.join(self.rows))
+        data.write(pack('>h', -1))
+        data.seek(0)
+        
+        columns = ', '.join([_quote_ident(name) for (name, type) in self.columns])
+        sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT binary)' % (_quote_ident(self.table), columns)
+        
+        self.conn.cursor().copy_expert(sql, data)
+        self.rows = []
+    
+    def close(self):
+        self.flush()
+        self.conn.commit()
@@ -0,0 +1,353 @@
+""" Compact array-backed skeleton graphs.
+
+A Skeleton keeps node coordinates, edges and edge lengths in NumPy arrays
+with CSR adjacency, in place of a networkx Graph holding a Point on every
+node and a LineString on every edge. Use Skeleton.to_networkx() where a
+networkx Graph is still wanted.
+"""
+from heapq import heappush, heappop
+from itertools import count
+from math import hypot
+
+import numpy
+
+try:
+    from networkx import Graph
+except ImportError:
+    # only needed for Skeleton.to_networkx()
+    pass
+
+from shapely.geometry import Point, LineString
+
+class _NoPath (Exception): pass
+
+class Skeleton:
+    """ Skeleton graph of (x, y) nodes joined by straight edges.
+        
+        Attributes:
+          
+          points
+            (n, 2) float array of node coordinates.
+          
+          edges
+            (m, 2) int array of pairs of node indexes.
+          
+          lengths
+            (m, ) float array of edge lengths.
+          
+          indptr, indices, edge_ids
+            CSR adjacency: neighbors of node i are indices[indptr[i]:indptr[i+1]],
+            reached by way of edges edge_ids[indptr[i]:indptr[i+1]].
+    """
+    _lists = None
+    
+    def __init__(self, points, edges):
+        self.points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        self.edges = numpy.asarray(edges, dtype=int).reshape(-1, 2)
+        
+        vectors = self.points[self.edges[:,1]] - self.points[self.edges[:,0]]
+        self.lengths = numpy.hypot(vectors[:,0], vectors[:,1])
+        
+        #
+        # Build CSR adjacency by listing every edge in both directions
+        # and sorting the result by originating node.
+        #
+        edge_ids = numpy.arange(len(self.edges))
+        sources = numpy.concatenate((self.edges[:,0], self.edges[:,1]))
+        targets = numpy.concatenate((self.edges[:,1], self.edges[:,0]))
+        order = numpy.argsort(sources, kind='mergesort')
+        
+        self.indices = targets[order]
+        self.edge_ids = numpy.concatenate((edge_ids, edge_ids))[order]
+        self.indptr = numpy.zeros(len(self.points) + 1, dtype=int)
+        numpy.cumsum(numpy.bincount(sources, minlength=len(self.points)), out=self.indptr[1:])
+    
+    def number_of_nodes(self):
+        return len(self.points)
+    
+    def number_of_edges(self):
+        return len(self.edges)
+    
+    def degrees(self):
+        """ Return an array of node degrees.
+        """
+        return numpy.diff(self.indptr)
+    
+    def as_lists(self):
+        """ Return xs, ys, indptr, indices, edge_ids, and lengths as Python lists.
+            
+            Plain lists are much quicker than arrays for one-at-a-time access
+            in pure-Python loops, and are computed once per skeleton.
+        """
+        if self._lists is None:
+            self._lists = (self.points[:,0].tolist(), self.points[:,1].tolist(),
+                           self.indptr.tolist(), self.indices.tolist(),
+                           self.edge_ids.tolist(), self.lengths.tolist())
+        
+        return self._lists
+    
+    def subgraph(self, node_mask, edge_mask):
+        """ Return a new Skeleton with only the selected nodes and edges.
+            
+            Selected edges must only join selected nodes.
+        """
+        node_ids = numpy.cumsum(node_mask) - 1
+        return Skeleton(self.points[node_mask], node_ids[self.edges[edge_mask]])
+    
+    def to_networkx(self):
+        """ Return a networkx Graph with point, line, and length attributes.
+        """
+        graph = Graph()
+        
+        for (index, (x, y)) in enumerate(self.points.tolist()):
+            graph.add_node(index, dict(point=Point(x, y)))
+        
+        for ((v, w), length) in zip(self.edges.tolist(), self.lengths.tolist()):
+            line = LineString(self.points[[v, w]])
+            graph.add_edge(v, w, dict(line=line, length=length))
+        
+        return graph
+
+def prune_spurs(skeleton, min_depth=20, deadline=None):
+    """ Return a copy of a skeleton with short dead-end spurs removed.
+        
+        Leaf nodes are removed while their accumulated depth is less than
+        min_depth, carrying depth plus edge length over to their neighbor.
+        
+        Leaves are worked off a single queue in the order that a repeated
+        scan over all nodes would visit them: a node that becomes a leaf
+        is handled later in the same scan if its index is higher than the
+        current node, or in the following scan if not. This gives the same
+        result as repeated scanning without rescanning every node.
+        
+        The optional util.Deadline is checked every thousand or so leaves.
+    """
+    degree = skeleton.degrees().tolist()
+    depth = [0.] * skeleton.number_of_nodes()
+    node_alive = [True] * skeleton.number_of_nodes()
+    edge_alive = [True] * skeleton.number_of_edges()
+    
+    xs, ys, indptr, indices, edge_ids, lengths = skeleton.as_lists()
+    
+    # (scan, index) tuples, already in heap order.
+    queue = [(0, index) for (index, links) in enumerate(degree) if links == 1]
+    
+    for counter in count(1):
+        if not queue:
+            break
+        
+        if deadline and counter % 1024 == 0:
+            deadline.check()
+        
+        scan, index = heappop(queue)
+        
+        if degree[index] != 1 or depth[index] >= min_depth:
+            continue
+        
+        for offset in range(indptr[index], indptr[index + 1]):
+            if edge_alive[edge_ids[offset]]:
+                other, edge = indices[offset], edge_ids[offset]
+                break
+        
+        depth[other] = depth[index] + lengths[edge]
+        degree[index] -= 1
+        degree[other] -= 1
+        node_alive[index] = False
+        edge_alive[edge] = False
+        
+        if degree[other] == 1:
+            heappush(queue, (scan if other > index else scan + 1, other))
+    
+    return skeleton.subgraph(numpy.array(node_alive, dtype=bool),
+                             numpy.array(edge_alive, dtype=bool))
+
+def astar_path(skeleton, edge_alive, source, target, weighted):
+    """ Return a list of node indexes on a shortest path from source to target.
+        
+        The same search as networkx.astar_path() with a Euclidean distance
+        heuristic, using only edges marked True in the edge_alive list.
+        Edges are weighted by length if weighted is true, or count as 1
+        otherwise.
+        
+        Neighbors are visited in CSR order rather than networkx adjacency
+        order, so where several paths cost the same, as often happens
+        unweighted, this can return a different one than networkx would.
+        
+        Raise _NoPath if target can't be reached.
+    """
+    xs, ys, indptr, indices, edge_ids, lengths = skeleton.as_lists()
+    tx, ty = xs[target], ys[target]
+    
+    c = count()
+    queue = [(0, next(c), source, 0, None)]
+    enqueued, explored = {}, {}
+    
+    while queue:
+        _, __, curnode, dist, parent = heappop(queue)
+        
+        if curnode == target:
+            path = [curnode]
+            node = parent
+            while node is not None:
+                path.append(node)
+                node = explored[node]
+            path.reverse()
+            return path
+        
+        if curnode in explored:
+            continue
+        
+        explored[curnode] = parent
+        
+        for offset in range(indptr[curnode], indptr[curnode + 1]):
+            neighbor, edge = indices[offset], edge_ids[offset]
+            if neighbor in explored or not edge_alive[edge]:
+                continue
+            ncost = dist + (lengths[edge] if weighted else 1)
+            if neighbor in enqueued:
+                qcost, h = enqueued[neighbor]
+                if qcost <= ncost:
+                    continue
+            else:
+                h = hypot(xs[neighbor] - tx, ys[neighbor] - ty)
+            enqueued[neighbor] = ncost, h
+            heappush(queue, (ncost + h, next(c), neighbor, ncost, curnode))
+    
+    raise _NoPath('Node %s not reachable from %s' % (target, source))
+
+def _dijkstra(skeleton, source, deadline=None):
+    """ Return nodes in order of discovery, distances, and parents from source.
+        
+        Distances and parents are dictionaries that cover only the
+        connected component containing the source node. The optional
+        util.Deadline is checked every thousand or so nodes.
+    """
+    xs, ys, indptr, indices, edge_ids, lengths = skeleton.as_lists()
+    
+    order, dist, parent = [], {source: 0.}, {source: None}
+    queue, done = [(0., source)], set()
+    
+    while queue:
+        d, node = heappop(queue)
+        
+        if node in done:
+            continue
+        
+        done.add(node)
+        order.append(node)
+        
+        if deadline and len(order) % 1024 == 0:
+            deadline.check()
+        
+        for offset in range(indptr[node], indptr[node + 1]):
+            neighbor, edge = indices[offset], edge_ids[offset]
+            ndist = d + lengths[edge]
+            if neighbor not in done and ndist < dist.get(neighbor, ndist + 1):
+                dist[neighbor], parent[neighbor] = ndist, (node, edge)
+                heappush(queue, (ndist, neighbor))
+    
+    return order, dist, parent
+
+def long_path_decomposition(skeleton, deadline=None):
+    """ Return a list of node index lists covering each edge exactly once, longest first.
+        
+        For each connected component, find one end of its diameter with
+        a pair of Dijkstra sweeps and grow a shortest-path tree from it.
+        The tree is split into long paths: the path from the root follows
+        the tallest branch at every node, and each branch left behind starts
+        a new path of its own. The whole thing is O(n log n).
+        
+        This is not the same as repeatedly taking the longest remaining
+        path. Where a node on a path has two branches of its own, they
+        become two paths, where the longest remaining path would run
+        from one branch through the node and into the other.
+        
+        Edges outside the tree, where the skeleton loops around a hole,
+        extend a path that ends at one of their nodes or else become short
+        paths of their own.
+        
+        The optional util.Deadline is checked every thousand or so nodes
+        or paths, so that one large component can't run far past it.
+    """
+    xs, ys, indptr, indices, edge_ids, lengths = skeleton.as_lists()
+    
+    seen = [False] * skeleton.number_of_nodes()
+    paths = []
+    
+    for start in range(skeleton.number_of_nodes()):
+        if seen[start] or indptr[start] == indptr[start + 1]:
+            continue
+        
+        order, dist, parent = _dijkstra(skeleton, start, deadline)
+        root = max(order, key=dist.get)
+        order, dist, parent = _dijkstra(skeleton, root, deadline)
+        
+        for node in order:
+            seen[node] = True
+        
+        #
+        # Find the tallest branch below each node by visiting
+        # the shortest-path tree from its leaves up to its root.
+        #
+        height, tallest = dict.fromkeys(order, 0.), dict()
+        
+        for node in reversed(order[1:]):
+            up, edge = parent[node]
+            if up not in tallest or height[node] + lengths[edge] > height[up]:
+                height[up], tallest[up] = height[node] + lengths[edge], node
+        
+        #
+        # Walk down from the root and from every branch point, following
+        # the tallest branch each time and queueing up the rest.
+        #
+        children = dict()
+        tree_edges = set()
+        
+        for node in order[1:]:
+            up, edge = parent[node]
+            children.setdefault(up, []).append(node)
+            tree_edges.add(edge)
+        
+        tails, heads = dict(), [(root, None)]
+        
+        while heads:
+            if deadline and len(paths) % 1024 == 0:
+                deadline.check()
+            
+            node, first = heads.pop()
+            path = [node] if first is None else [node, first]
+            node = path[-1]
+            
+            while node in tallest:
+                for child in children[node]:
+                    if child != tallest[node]:
+                        heads.append((node, child))
+                node = tallest[node]
+                path.append(node)
+            
+            tails[node] = path
+            paths.append(path)
+        
+        #
+        # Attach the remaining edges around any holes.
+        #
+        for node in order:
+            for offset in range(indptr[node], indptr[node + 1]):
+                other, edge = indices[offset], edge_ids[offset]
+                
+                if edge in tree_edges:
+                    continue
+                
+                tree_edges.add(edge)
+                
+                if node in tails:
+                    tails.pop(node).append(other)
+                elif other in tails:
+                    tails.pop(other).append(node)
+                else:
+                    paths.append([node, other])
+    
+    def path_length(path):
+        return sum([hypot(xs[v] - xs[w], ys[v] - ys[w]) for (v, w) in zip(path[:-1], path[1:])])
+    
+    return sorted(paths, key=path_length, reverse=True)
@@ -1,16 +1,65 @@
 from sys import stdin, stdout
-from math import hypot, ceil, sqrt, pi
-from base64 import b64encode, b64decode
+from math import hypot, sqrt, pi
+from time import time
+from struct import pack, unpack
 from json import loads as json_decode
 from json import dumps as json_encode
-from cPickle import loads as unpickle
-from cPickle import dumps as pickle
 from os.path import splitext
 from gzip import GzipFile
 from bz2 import BZ2File
 
-from shapely.geometry import Polygon
+import numpy
+
+from shapely.geometry import Point, LineString
 from shapely.wkb import loads as wkb_decode
+from shapely.prepared import prep
+
+try:
+    from shapely.vectorized import contains as vectorized_contains
+except ImportError:
+    # older Shapely, check points one at a time below
+    vectorized_contains = None
+
+class _DeadlineExceeded (Exception): pass
+
+class _TypedBytesFailure (Exception): pass
+
+class Deadline:
+    ''' Cooperative time budget, checked from inside long-running loops.
+    
+        Holds nothing but an absolute expiration time, so one instance
+        can be shared between threads or sent to another process.
+        Deadline() with no arguments never expires.
+    '''
+    def __init__(self, seconds=None):
+        self.expires = None if seconds is None else time() + seconds
+    
+    def remaining(self):
+        ''' Return seconds remaining, or None for no limit.
+        '''
+        if self.expires is None:
+            return None
+        
+        return max(0, self.expires - time())
+    
+    def expired(self):
+        return self.expires is not None and time() >= self.expires
+    
+    def check(self):
+        ''' Raise _DeadlineExceeded if time has run out.
+        '''
+        if self.expired():
+            raise _DeadlineExceeded('Deadline passed %.1f seconds ago' % (time() - self.expires))
+    
+    def limit(self, seconds):
+        ''' Return a new Deadline that expires in seconds or with this one, whichever is sooner.
+        '''
+        deadline = Deadline(seconds)
+        
+        if self.expires is not None:
+            deadline.expires = min(deadline.expires, self.expires)
+        
+        return deadline
 
 def zoom_buffer(width_px, zoom):
     '''
@@ -55,47 +104,61 @@ def point_distance(a, b):
     
 def simplify_line_vw(points, small_area=100):
     """ Simplify a line of points using V-W down to the given area.
+        
+        Points are removed in rounds, as they always have been: in each
+        round every triangle at or under small_area is visited from the
+        smallest up, and its apex removed unless a neighbor was removed
+        earlier in the round. Triangle areas for a round are found all
+        at once with NumPy, using the same arithmetic as GEOS polygon
+        areas, so the same points are kept as with shapely Polygons.
     """
-    while len(points) > 3:
+    points = list(points)
+    
+    if len(points) <= 3:
+        return points
+    
+    coords = numpy.array([(point[0], point[1]) for point in points], dtype=float)
+    kept = numpy.arange(len(points))
+    
+    while len(kept) > 3:
         
         # For each coordinate that forms the apex of a two-segment
-        # triangle, find the area of that triangle and put it into a list
-        # along with the index, ordered from smallest to largest.
-    
-        popped, preserved = set(), set()
+        # triangle, find the area of that triangle, and list the
+        # indexes of small ones ordered from smallest to largest.
+        
+        xs, ys = coords[kept,0], coords[kept,1]
+        x1, x2, x3, y1, y2, y3 = xs[:-2], xs[1:-1], xs[2:], ys[:-2], ys[1:-1], ys[2:]
+        areas = numpy.abs((x2 - x1) * (y1 - y3) + (x3 - x1) * (y2 - y1)) / 2
         
-        triples = zip(points[:-2], points[1:-1], points[2:])
-        triangles = [Polygon((p1, p2, p3)) for (p1, p2, p3) in triples]
-        areas = [(triangle.area, index) for (index, triangle) in enumerate(triangles)]
+        order = numpy.argsort(areas, kind='mergesort')
+        order = order[areas[order] <= small_area]
+        
+        if not len(order):
+            # nothing was removed so we are done
+            break
         
         # Reduce any segments that makes a triangle whose area is below
         # the minimum threshold, starting with the smallest and working up.
         # Mark segments to be preserved until the next iteration.
-
-        for (area, index) in sorted(areas):
-            if area > small_area:
-                # nothing more can be removed on this iteration
-                break
-            
+        
+        popped, preserved = [], set()
+        
+        for index in order.tolist():
             if (index + 1) in preserved:
                 # current index is too close to a previously-preserved one
                 continue
             
             preserved.add(index)
-            popped.add(index + 1)
+            popped.append(index + 1)
             preserved.add(index + 2)
         
-        if not popped:
-            # nothing was removed so we are done
-            break
-        
         # reduce the line, then try again
-        points = [point for (index, point) in enumerate(points) if index not in popped]
+        kept = numpy.delete(kept, popped)
     
-    return list(points)
+    return [points[index] for index in kept.tolist()]
 
 def simplify_line_dp(pts, tolerance):
-    """ Pure-Python Douglas-Peucker line simplification/generalization
+    """ Douglas-Peucker line simplification/generalization
         
         this code was written by Schuyler Erle <schuyler@nocat.net> and is
           made available in the public domain.
@@ -105,7 +168,13 @@ def simplify_line_dp(pts, tolerance):
         
         the original page is no longer available, but is mirrored at
           http://www.mappinghacks.com/code/PolyLineReduction/
+        
+        distances for each anchor/floater span are now found all at once
+        with NumPy, using the same arithmetic as the original inner loop
+        so the same points are kept.
     """
+    xs, ys = numpy.asarray(pts, dtype=float).reshape(len(pts), -1).T[:2]
+    
     anchor  = 0
     floater = len(pts) - 1
     stack   = []
@@ -116,43 +185,38 @@ def simplify_line_dp(pts, tolerance):
         anchor, floater = stack.pop()
       
         # initialize line segment
-        if pts[floater] != pts[anchor]:
-            anchorX = float(pts[floater][0] - pts[anchor][0])
-            anchorY = float(pts[floater][1] - pts[anchor][1])
+        if xs[floater] != xs[anchor] or ys[floater] != ys[anchor]:
+            anchorX = xs[floater] - xs[anchor]
+            anchorY = ys[floater] - ys[anchor]
             seg_len = sqrt(anchorX ** 2 + anchorY ** 2)
             # get the unit vector
             anchorX /= seg_len
             anchorY /= seg_len
         else:
-            anchorX = anchorY = seg_len = 0.0
-    
-        # inner loop:
-        max_dist = 0.0
-        farthest = anchor + 1
-        for i in range(anchor + 1, floater):
-            dist_to_seg = 0.0
-            # compare to anchor
-            vecX = float(pts[i][0] - pts[anchor][0])
-            vecY = float(pts[i][1] - pts[anchor][1])
-            seg_len = sqrt( vecX ** 2 + vecY ** 2 )
-            # dot product:
-            proj = vecX * anchorX + vecY * anchorY
-            if proj < 0.0:
-                dist_to_seg = seg_len
-            else: 
-                # compare to floater
-                vecX = float(pts[i][0] - pts[floater][0])
-                vecY = float(pts[i][1] - pts[floater][1])
-                seg_len = sqrt( vecX ** 2 + vecY ** 2 )
-                # dot product:
-                proj = vecX * (-anchorX) + vecY * (-anchorY)
-                if proj < 0.0:
-                    dist_to_seg = seg_len
-                else:  # calculate perpendicular distance to line (pythagorean theorem):
-                    dist_to_seg = sqrt(abs(seg_len ** 2 - proj ** 2))
-                if max_dist < dist_to_seg:
-                    max_dist = dist_to_seg
-                    farthest = i
+            anchorX = anchorY = 0.0
+    
+        # inner span, compared to anchor:
+        vecX = xs[anchor+1:floater] - xs[anchor]
+        vecY = ys[anchor+1:floater] - ys[anchor]
+        ahead = vecX * anchorX + vecY * anchorY >= 0.0
+        
+        # compared to floater:
+        vecX = xs[anchor+1:floater] - xs[floater]
+        vecY = ys[anchor+1:floater] - ys[floater]
+        seg_len = numpy.sqrt(vecX ** 2 + vecY ** 2)
+        proj = vecX * (-anchorX) + vecY * (-anchorY)
+        
+        # calculate perpendicular distance to line (pythagorean theorem),
+        # or distance to floater for points beyond it. Points behind the
+        # anchor never count toward the farthest point.
+        dist_to_seg = numpy.where(proj < 0.0, seg_len, numpy.sqrt(numpy.abs(seg_len ** 2 - proj ** 2)))
+        dist_to_seg[~ahead] = 0.0
+        
+        if len(dist_to_seg):
+            farthest = anchor + 1 + int(dist_to_seg.argmax())
+            max_dist = dist_to_seg[farthest - anchor - 1]
+        else:
+            max_dist = 0.0
 
         if max_dist <= tolerance: # use line segment
             keep.add(anchor)
@@ -167,22 +231,24 @@ def simplify_line_dp(pts, tolerance):
 
 def densify_line(points, distance):
     """ Densify a line of points using the given distance.
+        
+        Accepts a list or (n, 2) array of points and returns an array.
+        Each segment is cut into the fewest equal steps no longer than
+        distance, all at once instead of one point at a time.
     """
-    coords = [points[0]]
+    points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+    deltas = numpy.diff(points, axis=0)
+    steps = numpy.ceil(numpy.hypot(deltas[:,0], deltas[:,1]) / distance).astype(int)
     
-    for curr_coord in list(points)[1:]:
-        prev_coord = coords[-1]
-    
-        dx, dy = curr_coord[0] - prev_coord[0], curr_coord[1] - prev_coord[1]
-        steps = ceil(hypot(dx, dy) / distance)
-        count = int(steps)
-        
-        while count:
-            prev_coord = prev_coord[0] + dx/steps, prev_coord[1] + dy/steps
-            coords.append(prev_coord)
-            count -= 1
+    #
+    # Every new point belongs to one segment and sits some number of steps
+    # along it; steps run from 1 up to and including the segment's end.
+    #
+    segments = numpy.repeat(numpy.arange(len(deltas)), steps)
+    offsets = numpy.arange(1, steps.sum() + 1) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+    fractions = offsets / steps[segments].astype(float)
     
-    return coords
+    return numpy.vstack((points[:1], points[segments] + deltas[segments] * fractions[:,None]))
 
 def polygon_rings(polygon):
     """ Given a buffer polygon, return a series of point rings.
@@ -200,6 +266,31 @@ def polygon_rings(polygon):
     
     return rings
 
+def polygon_containment(polygon, vertices, segments):
+    """ Given a polygon, return boolean masks of vertices and segments within it.
+    
+        Vertices are an (n, 2) array of (x, y) points, and segments are
+        a (k, 2) array of pairs of indexes into vertices. All tests are
+        made against a single prepared copy of the polygon, and segments
+        are only tested when both of their vertices are within it.
+    """
+    prepared = prep(polygon)
+    vertices = numpy.asarray(vertices, dtype=float).reshape(-1, 2)
+    segments = numpy.asarray(segments, dtype=int).reshape(-1, 2)
+    
+    if vectorized_contains is not None:
+        vertex_mask = vectorized_contains(prepared, vertices[:,0], vertices[:,1])
+    else:
+        vertex_mask = numpy.array([prepared.contains(Point(x, y)) for (x, y) in vertices], dtype=bool)
+    
+    segment_mask = vertex_mask[segments].all(1)
+    
+    for index in numpy.flatnonzero(segment_mask):
+        line = LineString(vertices[segments[index]])
+        segment_mask[index] = prepared.contains(line)
+    
+    return numpy.asarray(vertex_mask, dtype=bool).reshape(-1), segment_mask
+
 def open_file(name, mode='r'):
     """
     """
@@ -219,33 +310,108 @@ def open_file(name, mode='r'):
 
     return open(name, mode)
 
-def hadoop_feature_line(id, properties, geometry):
-    ''' Convert portions of a GeoJSON feature to a single line of text.
+#
+# Hadoop typed bytes type codes, used for records passed from mapper to reducer.
+# http://hadoop.apache.org/docs/current/api/org/apache/hadoop/typedbytes/package-summary.html
+#
+_typedbytes_bytes, _typedbytes_string, _typedbytes_vector = 0, 7, 8
+
+def _read_typedbytes(input):
+    ''' Return one typed bytes object from a file-like input stream, or None at the end.
+        
+        Only bytes, strings, and vectors of those are supported, and strings
+        are returned undecoded. Raise _TypedBytesFailure if the stream can't
+        be read, because once framing is lost nothing after it can be found.
+    '''
+    code = input.read(1)
     
-        Allows Hadoop to stream features from the mapper to the reducer.
+    if not code:
+        return None
+    
+    code, = unpack('>B', code)
+    
+    if code not in (_typedbytes_bytes, _typedbytes_string, _typedbytes_vector):
+        raise _TypedBytesFailure('Unsupported typed bytes type code %d' % code)
+    
+    head = input.read(4)
+    
+    if len(head) < 4:
+        raise _TypedBytesFailure('Truncated typed bytes length')
+    
+    length, = unpack('>i', head)
+    
+    if length < 0:
+        raise _TypedBytesFailure('Negative typed bytes length %d' % length)
+    
+    if code == _typedbytes_vector:
+        values = [_read_typedbytes(input) for i in range(length)]
+        
+        if None in values:
+            raise _TypedBytesFailure('Truncated typed bytes vector')
+        
+        return values
+    
+    value = input.read(length)
+    
+    if len(value) < length:
+        raise _TypedBytesFailure('Truncated typed bytes value')
+    
+    return value
+
+def hadoop_feature_record(id, properties, geometry):
+    ''' Convert portions of a GeoJSON feature to a typed bytes key and value.
+        
+        Allows Hadoop to stream features from the mapper to the reducer,
+        with stream.map.output and stream.reduce.input set to "typedbytes".
+        The key is a string id, and the value is a vector of JSON-encoded
+        properties and geometry WKB.
+        
         See also skeletron-hadoop-mapper.py and skeletron-hadoop-reducer.py.
     '''
-    line = [
-        json_encode(id),
-        ' ',
-        b64encode(pickle(sorted(list(properties.items())))),
-        '\t',
-        b64encode(geometry.wkb)
+    id = id.encode('utf8') if type(id) is unicode else id
+    prop = json_encode(properties, separators=(',', ':'), sort_keys=True)
+    wkb = geometry.wkb
+    
+    record = [
+        pack('>Bi', _typedbytes_string, len(id)), id,
+        pack('>Bi', _typedbytes_vector, 2),
+        pack('>Bi', _typedbytes_string, len(prop)), prop,
+        pack('>Bi', _typedbytes_bytes, len(wkb)), wkb
         ]
     
-    return ''.join(line)
+    return ''.join(record)
 
-def hadoop_line_features(line):
-    ''' Convert a correctly-formatted line of text to a list of GeoJSON features.
-    
+def hadoop_records(input):
+    ''' Generate (id, properties, WKB) tuples of undecoded typed bytes records.
+        
+        Reads the keys and values written by hadoop_feature_record()
+        one record at a time, and raises _TypedBytesFailure on input
+        that doesn't follow that format.
+    '''
+    while True:
+        id = _read_typedbytes(input)
+        
+        if id is None:
+            break
+        
+        value = _read_typedbytes(input)
+        
+        if type(value) is not list or len(value) != 2:
+            raise _TypedBytesFailure('Expected properties and geometry after key %s' % repr(id))
+        
+        prop, wkb = value
+        
+        yield id, prop, wkb
+
+def hadoop_record_features(id, prop, wkb):
+    ''' Convert one record from hadoop_records() to a list of GeoJSON features.
+        
         Allows Hadoop to stream features from the mapper to the reducer.
         See also skeletron-hadoop-mapper.py and skeletron-hadoop-reducer.py.
     '''
-    id, prop, geom = line.split()
-    
-    id = json_decode(id)
-    properties = dict(unpickle(b64decode(prop)))
-    geometry = wkb_decode(b64decode(geom))
+    id = id.decode('utf8')
+    properties = json_decode(prop)
+    geometry = wkb_decode(wkb)
     
     parts = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
     
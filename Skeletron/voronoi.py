@@ -0,0 +1,101 @@
+""" Voronoi diagram backends for polygon_dots_skeleton().
+
+Each backend accepts a list or (n, 2) array of (x, y) points and returns
+a pair of NumPy arrays: an (m, 2) float array of Voronoi vertices and a
+(k, 2) int array of ridges, given as pairs of indexes into the vertices.
+Ridges that extend to infinity are omitted.
+
+Two backends are available:
+
+  qhull
+    In-process QHull via scipy.spatial.Voronoi, the default when scipy
+    can be imported.
+
+  qvoronoi
+    External qvoronoi binary from http://www.qhull.org, run once per
+    call with points and vertices passed around as text.
+"""
+from subprocess import Popen, PIPE
+
+import numpy
+
+try:
+    from scipy.spatial import Voronoi
+    from scipy.spatial.qhull import QhullError
+except ImportError:
+    # fall back to the qvoronoi binary
+    Voronoi = None
+
+class _QHullFailure (Exception): pass
+
+def qhull_voronoi(points):
+    """ Return vertices and ridges for a list of points using scipy.spatial.
+    """
+    #
+    # Round to the same two decimal places used in qvoronoi_voronoi()
+    # so that both backends see identical input.
+    #
+    points = numpy.round(numpy.asarray(points, dtype=float), 2)
+
+    try:
+        voronoi = Voronoi(points)
+    except QhullError, e:
+        raise _QHullFailure(str(e).splitlines()[0])
+
+    ridges = numpy.array(voronoi.ridge_vertices, dtype=int).reshape(-1, 2)
+    ridges = ridges[(ridges >= 0).all(1)]
+
+    return voronoi.vertices, ridges
+
+def qvoronoi_voronoi(points):
+    """ Return vertices and ridges for a list of points using qvoronoi binary.
+    """
+    rbox = '\n'.join( ['2', str(len(points))] + ['%.2f %.2f' % (x, y) for (x, y) in points] + [''] )
+
+    qvoronoi = Popen('qvoronoi o'.split(), stdin=PIPE, stdout=PIPE)
+    output, error = qvoronoi.communicate(rbox)
+    voronoi_lines = output.splitlines()
+
+    if qvoronoi.returncode:
+        raise _QHullFailure('Failed with code %s' % qvoronoi.returncode)
+
+    vert_count, poly_count = map(int, voronoi_lines[1].split()[:2])
+
+    #
+    # The first vertex in qvoronoi output is the point at infinity;
+    # drop it here and shift the remaining region indexes to match.
+    #
+    vertices = [map(float, line.split()[:2]) for line in voronoi_lines[3:2+vert_count]]
+    vertices = numpy.array(vertices, dtype=float).reshape(-1, 2)
+
+    ridges = []
+
+    for line in voronoi_lines[2+vert_count:2+vert_count+poly_count]:
+        indexes = map(int, line.split()[1:])
+        ridges.extend([(v - 1, w - 1) for (v, w) in zip(indexes, indexes[1:] + indexes[:1]) if v and w])
+
+    ridges = numpy.array(ridges, dtype=int).reshape(-1, 2)
+
+    # Each ridge is seen from the regions on both sides of it.
+    ridges = numpy.unique(numpy.sort(ridges, 1), axis=0)
+
+    return vertices, ridges
+
+backends = dict(qhull=qhull_voronoi, qvoronoi=qvoronoi_voronoi)
+
+def voronoi_backend(voronoi=None):
+    """ Return a Voronoi backend function for a name, function, or None.
+
+        None selects the in-process qhull backend when scipy is available
+        and falls back to the qvoronoi binary otherwise.
+    """
+    if callable(voronoi):
+        return voronoi
+
+    if voronoi is None:
+        voronoi = Voronoi and 'qhull' or 'qvoronoi'
+
+    if voronoi not in backends:
+        raise ValueError('Unknown Voronoi backend "%s"' % voronoi)
+
+    return backends[voronoi]
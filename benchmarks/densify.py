@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" Benchmark util.densify_line() against the original point-by-point loop.
+
+Densifies the buffer ring of a synthetic route with many vertices, the
+kind of ring that long route relations produce, at half the buffer size.
+
+Run from the top of the repository:
+
+    python benchmarks/densify.py
+"""
+from os.path import dirname, join
+from optparse import OptionParser
+from random import Random
+from math import hypot, ceil
+from time import time
+import sys
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from shapely.geometry import LineString
+
+from Skeletron.util import densify_line
+
+def original_densify_line(points, distance):
+    """ Densify a line of points using the given distance, as in Skeletron 0.10.0.
+    """
+    coords = [points[0]]
+    
+    for curr_coord in list(points)[1:]:
+        prev_coord = coords[-1]
+        
+        dx, dy = curr_coord[0] - prev_coord[0], curr_coord[1] - prev_coord[1]
+        steps = ceil(hypot(dx, dy) / distance)
+        count = int(steps)
+        
+        while count:
+            prev_coord = prev_coord[0] + dx/steps, prev_coord[1] + dy/steps
+            coords.append(prev_coord)
+            count -= 1
+    
+    return coords
+
+def best_time(function, args, repeat):
+    """ Return the result and the best time in seconds of a few calls to function.
+    """
+    times = []
+    
+    for i in range(repeat):
+        start = time()
+        result = function(*args)
+        times.append(time() - start)
+    
+    return result, min(times)
+
+def benchmark_densify(vertices, buffer, repeat):
+    """ Time densifying the buffer ring of a random route with some number of vertices.
+    """
+    random, x, y, points = Random(0), 0., 0., []
+    
+    for i in range(vertices):
+        x, y = x + random.uniform(5, 50), y + random.uniform(-30, 30)
+        points.append((x, y))
+    
+    ring = list(LineString(points).buffer(buffer, 3).exterior.coords)
+    
+    new, new_time = best_time(densify_line, (ring, buffer/2), repeat)
+    old, old_time = best_time(original_densify_line, (ring, buffer/2), repeat)
+    
+    assert len(new) <= len(old)
+    
+    print 'Densify %d-vertex route: %d ring vertices, %d points at %.0fm' % (vertices, len(ring), len(new), buffer/2)
+    print '  original loop:  %.1fms' % (old_time * 1000)
+    print '  densify_line(): %.1fms' % (new_time * 1000)
+
+optparser = OptionParser(usage="""%prog [options]""")
+
+defaults = dict(vertices=4000, buffer=24, repeat=3)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('--vertices', dest='vertices', type='int',
+                     help='Number of vertices in synthetic route. Default value is %s.' % repr(defaults['vertices']))
+
+optparser.add_option('--buffer', dest='buffer', type='float',
+                     help='Buffer around synthetic route in meters. Default value is %s.' % repr(defaults['buffer']))
+
+optparser.add_option('--repeat', dest='repeat', type='int',
+                     help='Number of times to run each one, keeping the best time. Default value is %s.' % repr(defaults['repeat']))
+
+if __name__ == '__main__':
+    options, args = optparser.parse_args()
+    benchmark_densify(options.vertices, options.buffer, options.repeat)
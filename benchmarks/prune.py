@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+""" Benchmark skeleton.prune_spurs() against the original networkx loop.
+
+Prunes every skeleton of every part of the Oakland sample at zooms 14-18,
+at depth 20 and at the buffer size, with skeleton.prune_spurs() and with
+the loop that polygon_dots_skeleton() used to run over a networkx Graph.
+Results are checked to be the same.
+
+Run from the top of the repository:
+
+    python benchmarks/prune.py
+"""
+from os.path import dirname, join, basename
+from optparse import OptionParser
+from time import time
+from json import load
+import sys
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from shapely.geometry import asShape
+
+from Skeletron import projected_multigeometry, polygon_dots_parts, _buffered_multiline_polygon, _buffered_multipoly_polygon
+from Skeletron.util import zoom_buffer, polygon_containment
+from Skeletron.skeleton import Skeleton, prune_spurs
+from Skeletron.voronoi import voronoi_backend
+
+def original_prune_spurs(skeleton, min_depth):
+    """ Prune a networkx skeleton in place, as in Skeletron 0.10.0.
+    """
+    removing = True
+    
+    while removing:
+        removing = False
+        
+        for index in skeleton.nodes():
+            if skeleton.degree(index) == 1:
+                depth = skeleton.node[index].get('depth', 0)
+                if depth < min_depth:
+                    other = skeleton.neighbors(index)[0]
+                    skeleton.node[other]['depth'] = depth + skeleton.edge[index][other]['line'].length
+                    skeleton.remove_node(index)
+                    removing = True
+
+def best_time(function, args, repeat):
+    """ Return the result and the best time in seconds of a few calls to function.
+    """
+    times = []
+    
+    for i in range(repeat):
+        start = time()
+        result = function(*args)
+        times.append(time() - start)
+    
+    return result, min(times)
+
+def benchmark_prune(filename, zooms, repeat):
+    """ Time pruning the skeleton of every part of every feature in a GeoJSON file.
+    """
+    features = load(open(filename))['features']
+    new_time, old_time, count = 0., 0., 0
+    
+    for zoom in zooms:
+        buffer = zoom_buffer(15, zoom)
+        
+        for feature in features:
+            multigeom = projected_multigeometry(asShape(feature['geometry']))
+            
+            if multigeom.type == 'MultiLineString':
+                buffered = _buffered_multiline_polygon(multigeom, buffer)
+            else:
+                buffered = _buffered_multipoly_polygon(multigeom, buffer)
+            
+            for polygon in getattr(buffered, 'geoms', [buffered]):
+                for (part, points) in polygon_dots_parts(polygon, buffer, buffer/2):
+                    vertices, ridges = voronoi_backend()(points)
+                    vertex_mask, ridge_mask = polygon_containment(part, vertices, ridges)
+                    skeleton = Skeleton(vertices, ridges).subgraph(vertex_mask, ridge_mask)
+                    
+                    for min_depth in (20, buffer):
+                        pruned, seconds = best_time(prune_spurs, (skeleton, min_depth), repeat)
+                        new_time += seconds
+                        
+                        graphs = [skeleton.to_networkx() for i in range(repeat)]
+                        ignored, seconds = best_time(lambda: original_prune_spurs(graphs.pop(), min_depth), (), repeat)
+                        old_time += seconds
+                        
+                        graph = skeleton.to_networkx()
+                        original_prune_spurs(graph, min_depth)
+                        
+                        lines = [tuple(sorted(map(tuple, pruned.points[edge].tolist()))) for edge in pruned.edges]
+                        old_lines = [tuple(sorted(map(tuple, skeleton.points[[v, w]].tolist()))) for (v, w) in graph.edges()]
+                        
+                        assert sorted(lines) == sorted(old_lines), 'Pruned skeletons differ'
+                        count += 1
+    
+    print 'Prune %d skeletons from %s at zooms %s, all identical' % (count, basename(filename), ', '.join(map(str, zooms)))
+    print '  original networkx loop: %.3fs' % old_time
+    print '  prune_spurs():          %.3fs' % new_time
+
+optparser = OptionParser(usage="""%prog [options]""")
+
+defaults = dict(sample=join(dirname(__file__), '..', 'oakland-sample.json'), repeat=3)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('--sample', dest='sample',
+                     help='GeoJSON file of features to prune skeletons of. Default value is the Oakland sample.')
+
+optparser.add_option('--repeat', dest='repeat', type='int',
+                     help='Number of times to run each one, keeping the best time. Default value is %s.' % repr(defaults['repeat']))
+
+if __name__ == '__main__':
+    options, args = optparser.parse_args()
+    benchmark_prune(options.sample, (14, 15, 16, 17, 18), options.repeat)
@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
-from Skeletron import __version__
+from re import search
+
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
+
+# Skeletron can't be imported before its dependencies are installed.
+__version__ = search(r"__version__ = '(.+)'", open('Skeletron/__init__.py').read()).group(1)
 
 setup(name='Skeletron',
       version=__version__,
@@ -10,6 +17,7 @@ setup(name='Skeletron',
       author_email='mike@stamen.com',
       url='https://github.com/migurski/Skeletron',
       requires=['networkx', 'StreetNames'],
+      install_requires=['numpy', 'scipy'],
       packages=['Skeletron'],
       scripts=['skeletron-generalize.py',
                'skeletron-hadoop-mapper.py',
@@ -1,27 +1,55 @@
 #!/usr/bin/env python
-from json import load, JSONEncoder
 from optparse import OptionParser
+from multiprocessing import Pool
 from itertools import repeat
-from re import compile
 import logging
 
-from Skeletron.output import generalize_geojson_feature
+from Skeletron.input import geojson_features, geojsonseq_features
+from Skeletron.output import generalize_geojson_feature, generalize_geojson_feature_zooms, GeoJSONWriter
+from Skeletron.util import open_file
+from Skeletron.cache import Cache
+from Skeletron.postgis import postgis_features, PostGISWriter
+
+try:
+    from psycopg2 import connect
+except ImportError:
+    # only needed for PostGIS input or output
+    connect = None
 
-float_pat = compile(r'^-?\d+\.\d+(e-?\d+)?$')
-charfloat_pat = compile(r'^[\[,\,]-?\d+\.\d+(e-?\d+)?$')
 earth_radius = 6378137
 
+def single_features(feature):
+    ''' Convert one feature with a multi-geometry into a list of features.
+    '''
+    if not feature['geometry']['type'].startswith('Multi'):
+        return [feature]
+    
+    coord = [part for part in feature['geometry']['coordinates']]
+    types = repeat(feature['geometry']['type'][5:])
+    props = repeat(feature['properties'])
+    
+    return [dict(type='Feature', geometry=dict(coordinates=coords, type=type), properties=prop)
+            for (coords, type, prop) in zip(coord, types, props)]
+
 optparser = OptionParser(usage="""%prog [options] <geojson input file> <geojson output file>
 
-Accepts GeoJSON input and generates GeoJSON output.""")
+Accepts GeoJSON input and generates GeoJSON output, one feature at a time.
+Use "-" for stdin or stdout.
+
+With --input-format postgis, the input is an SQL query run against the
+database given by --dsn, and with --output-format postgis the output is
+the name of a table to copy generalized features into.""")
 
-defaults = dict(zoom=12, width=15, single=False, loglevel=logging.INFO)
+defaults = dict(zoom=12, zooms=None, width=15, single=False, workers=1, cache=None, cache_size=100, input_format='collection', output_format='collection', dsn='', geometry_column='way', precision=5, loglevel=logging.INFO)
 
 optparser.set_defaults(**defaults)
 
 optparser.add_option('-z', '--zoom', dest='zoom',
                      type='int', help='Zoom level. Default value is %s.' % repr(defaults['zoom']))
 
+optparser.add_option('--zooms', dest='zooms',
+                     help='Comma-separated list of zoom levels such as "12,13,14", overriding --zoom. Each output feature gets a "zoomlevel" property, and work is shared between zoom levels.')
+
 optparser.add_option('-w', '--width', dest='width',
                      type='float', help='Line width at zoom level. Default value is %s.' % repr(defaults['width']))
 
@@ -29,6 +57,30 @@ optparser.add_option('-s', '--single', dest='single',
                      action='store_true',
                      help='Convert multi-geometries into single geometries on output.')
 
+optparser.add_option('--workers', dest='workers',
+                     type='int', help='Number of worker processes for generalizing parts of each feature in parallel. Default value is %s.' % repr(defaults['workers']))
+
+optparser.add_option('--cache', dest='cache',
+                     help='Optional directory for caching generalized results between runs.')
+
+optparser.add_option('--cache-size', dest='cache_size',
+                     type='int', help='Maximum size of cache directory in megabytes. Default value is %s.' % repr(defaults['cache_size']))
+
+optparser.add_option('--input-format', dest='input_format',
+                     choices=('collection', 'seq', 'postgis'), help='Input format: "collection" for a GeoJSON FeatureCollection, "seq" for newline-delimited GeoJSON features, or "postgis" for rows of a query. Default value is "%s".' % defaults['input_format'])
+
+optparser.add_option('--output-format', dest='output_format',
+                     choices=('collection', 'seq', 'postgis'), help='Output format: "collection" for a GeoJSON FeatureCollection, "seq" for newline-delimited GeoJSON features, or "postgis" for rows copied into a table. Default value is "%s".' % defaults['output_format'])
+
+optparser.add_option('--dsn', dest='dsn',
+                     help='PostgreSQL connection string for PostGIS input or output, such as "dbname=gis user=gis". Default value is "%s".' % defaults['dsn'])
+
+optparser.add_option('--geometry-column', dest='geometry_column',
+                     help='Name of the geometry column for PostGIS input or output. Default value is "%s".' % defaults['geometry_column'])
+
+optparser.add_option('--precision', dest='precision',
+                     type='int', help='Decimal places in output coordinates. Default value is %s.' % repr(defaults['precision']))
+
 optparser.add_option('-v', '--verbose', dest='loglevel',
                      action='store_const', const=logging.DEBUG,
                      help='Output extra progress information.')
@@ -40,56 +92,72 @@ optparser.add_option('-q', '--quiet', dest='loglevel',
 if __name__ == '__main__':
 
     options, (input_file, output_file) = optparser.parse_args()
-
+    
     logging.basicConfig(level=options.loglevel, format='%(levelname)08s - %(message)s')
     
+    if 'postgis' in (options.input_format, options.output_format) and connect is None:
+        optparser.error('PostGIS input or output requires psycopg2')
+    
     #
     # Input
     #
     
-    input = load(open(input_file, 'r'))
-    features = []
+    if options.input_format == 'postgis':
+        #
+        # Input gets a connection of its own, because its server-side
+        # cursor is still open while output is being copied and committed.
+        #
+        input_features = postgis_features(connect(options.dsn), input_file, options.geometry_column)
     
-    for (index, input_feature) in enumerate(input['features']):
-        try:
-            feature = generalize_geojson_feature(input_feature, options.width, options.zoom)
-            
-            if not feature:
-                continue
-
-        except Exception, err:
-            logging.error('Error on feature #%d: %s' % (index, err))
-
-        else:
-            if options.single and feature['geometry']['type'].startswith('Multi'):
-                coord = [part for part in feature['geometry']['coordinates']]
-                types = repeat(feature['geometry']['type'][5:])
-                props = repeat(feature['properties'])
-                
-                features.extend([dict(type='Feature', geometry=dict(coordinates=coords, type=type), properties=prop)
-                                 for (coords, type, prop) in zip(coord, types, props)])
-            
-            else:
-                features.append(feature)
+    elif options.input_format == 'seq':
+        input_features = geojsonseq_features(open_file(input_file, 'r'))
     
-    #
-    # Output
-    #
+    else:
+        input_features = geojson_features(open_file(input_file, 'r'))
     
-    geojson = dict(type='FeatureCollection', features=filter(None, features))
-    output = open(output_file, 'w')
-
-    encoder = JSONEncoder(separators=(',', ':'))
-    encoded = encoder.iterencode(geojson)
+    zooms = options.zooms and map(int, options.zooms.split(','))
+    cache = options.cache and Cache(options.cache, options.cache_size * 1024 * 1024)
     
-    for token in encoded:
-        if charfloat_pat.match(token):
-            # in python 2.7, we see a character followed by a float literal
-            output.write(token[0] + '%.5f' % float(token[1:]))
-        
-        elif float_pat.match(token):
-            # in python 2.6, we see a simple float literal
-            output.write('%.5f' % float(token))
+    pool = Pool(options.workers) if options.workers > 1 else None
+    
+    try:
+        #
+        # Output, written one feature at a time as each one is generalized.
+        #
         
+        if options.output_format == 'postgis':
+            output = PostGISWriter(connect(options.dsn), output_file, options.geometry_column)
         else:
-            output.write(token)
+            output = GeoJSONWriter(open_file(output_file, 'w'), options.precision, options.output_format)
+        
+        for (index, input_feature) in enumerate(input_features):
+            try:
+                if zooms:
+                    generalized = generalize_geojson_feature_zooms(input_feature, options.width, zooms, pool, cache)
+                else:
+                    feature = generalize_geojson_feature(input_feature, options.width, options.zoom, pool, cache)
+                    generalized = feature and [feature] or []
+            
+            except Exception, err:
+                logging.error('Error on feature #%d: %s' % (index, err))
+            
+            else:
+                for feature in generalized:
+                    features = single_features(feature) if options.single else [feature]
+                    
+                    try:
+                        for feature in features:
+                            output.write(feature)
+                    
+                    except ValueError, err:
+                        logging.error('Error on feature #%d: %s' % (index, err))
+        
+        output.close()
+    
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    
+    if cache:
+        logging.info('Cache: %d hits, %d misses' % (cache.hits, cache.misses))
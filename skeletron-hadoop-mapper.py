@@ -1,49 +1,49 @@
 #!/usr/bin/env python
-'''
+r'''
+
+Reads newline-delimited GeoJSON features, one line at a time, and writes
+typed bytes records. Run with "-D stream.map.output=typedbytes" and
+"-D stream.reduce.input=typedbytes" options to Hadoop streaming.
 
-Test usage:
-    cat oakland-sample.json | ./skeletron-hadoop-mapper.py | sort | ./skeletron-hadoop-reducer.py > output.json
+Test usage, after converting the FeatureCollection in oakland-sample.json:
+    python -c 'import json, sys; sys.stdout.writelines([json.dumps(f) + "\n" for f in json.load(sys.stdin)["features"]])' < oakland-sample.json > oakland-sample.geojsonseq
+    ./skeletron-hadoop-mapper.py < oakland-sample.geojsonseq | ./skeletron-hadoop-reducer.py > output.json
 '''
 from sys import stdin, stdout
-from json import load, dumps
-from itertools import product
+from json import dumps
 from uuid import uuid1
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)08s - %(message)s')
 
 from shapely.geometry import asShape
-from Skeletron.output import generalize_geometry
-from Skeletron.util import hadoop_feature_line
+from Skeletron.output import generalize_geometry_zooms
+from Skeletron.input import geojsonseq_features
+from Skeletron.util import hadoop_feature_record
 
 if __name__ == '__main__':
 
-    geojson = load(stdin)
     pixelwidth = 20
     
-    for (feature, zoom) in product(geojson['features'], (12, 13, 14, 15, 16)):
+    for feature in geojsonseq_features(stdin):
 
-        id = str(uuid1())
         prop = feature.get('properties', {})
         geom = asShape(feature['geometry'])
     
         try:
-            skeleton = generalize_geometry(geom, pixelwidth, zoom)
-            bones = getattr(skeleton, 'geoms', [skeleton])
-            prop.update(dict(zoomlevel=zoom, pixelwidth=pixelwidth))
+            skeletons = generalize_geometry_zooms(geom, pixelwidth, (12, 13, 14, 15, 16))
             
+        except Exception, e:
+            logging.error(str(e))
+            continue
+        
+        for (zoom, skeleton) in sorted(skeletons.items()):
             if not skeleton:
                 logging.debug('Empty skeleton')
                 continue
             
-        except Exception, e:
-            logging.error(str(e))
-            continue
+            id = str(uuid1())
+            prop.update(dict(zoomlevel=zoom, pixelwidth=pixelwidth))
         
-        if id is None:
-            for (index, bone) in enumerate(bones):
-                logging.info('line %d of %d from %s' % (1 + index, len(bones), dumps(prop)))
-                print >> stdout, hadoop_feature_line(id, prop, bone)
-        else:
-            logging.info('%d-part multiline from %s' % (len(bones), dumps(prop)))
-            print >> stdout, hadoop_feature_line(id, prop, skeleton)
+            logging.info('%d-part multiline from %s' % (len(getattr(skeleton, 'geoms', [skeleton])), dumps(prop)))
+            stdout.write(hadoop_feature_record(id, prop, skeleton))
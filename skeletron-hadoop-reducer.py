@@ -1,45 +1,43 @@
 #!/usr/bin/env python
 '''
 
+Reads typed bytes records from skeletron-hadoop-mapper.py and writes a
+GeoJSON FeatureCollection.
+
 Test usage:
-    cat oakland-sample.json | ./skeletron-hadoop-mapper.py | sort | ./skeletron-hadoop-reducer.py > output.json
+    ./skeletron-hadoop-mapper.py < oakland-sample.geojsonseq | ./skeletron-hadoop-reducer.py > output.json
+
+See skeletron-hadoop-mapper.py for making oakland-sample.geojsonseq.
 '''
-from sys import stdout, stdin
-from json import loads, JSONEncoder
-from re import compile
+from sys import stdout, stdin, exit
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)08s - %(message)s')
 
-from Skeletron.util import hadoop_line_features
-
-float_pat = compile(r'^-?\d+\.\d+(e-?\d+)?$')
-charfloat_pat = compile(r'^[\[,\,]-?\d+\.\d+(e-?\d+)?$')
+from Skeletron.util import hadoop_records, hadoop_record_features, _TypedBytesFailure
+from Skeletron.output import GeoJSONWriter
 
 if __name__ == '__main__':
 
-    features = []
+    output = GeoJSONWriter(stdout, 5)
     
-    for line in stdin:
-        try:
-            features.extend(hadoop_line_features(line))
-        
-        except Exception, e:
-            logging.error(str(e))
-            continue
-
-    geojson = dict(type='FeatureCollection', features=features)
-    encoder = JSONEncoder(separators=(',', ':'))
-    encoded = encoder.iterencode(geojson)
+    try:
+        for (id, prop, wkb) in hadoop_records(stdin):
+            try:
+                features = hadoop_record_features(id, prop, wkb)
+            
+            except Exception, e:
+                logging.error(str(e))
+                continue
+            
+            for feature in features:
+                output.write(feature)
     
-    for token in encoded:
-        if charfloat_pat.match(token):
-            # in python 2.7, we see a character followed by a float literal
-            stdout.write(token[0] + '%.5f' % float(token[1:]))
-        
-        elif float_pat.match(token):
-            # in python 2.6, we see a simple float literal
-            stdout.write('%.5f' % float(token))
+    except _TypedBytesFailure, e:
+        logging.error('Unreadable typed bytes input, check that stream.reduce.input is "typedbytes": %s' % e)
         
-        else:
-            stdout.write(token)
+        # finish the JSON with any features written so far.
+        output.close()
+        exit(1)
+
+    output.close()
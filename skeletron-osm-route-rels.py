@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 """ Run with "--help" flag for more information.
 
-Accepts OpenStreetMap XML input and generates GeoJSON output for routes
+Accepts OpenStreetMap XML or PBF input and generates GeoJSON output for routes
 using the "network", "ref" and "modifier" tags to group relations.
 More on route relations: http://wiki.openstreetmap.org/wiki/Relation:route
 """
@@ -11,26 +11,30 @@ from itertools import combinations
 from optparse import OptionParser
 from csv import DictReader
 from re import compile
-from json import dump
+from json import dump, load
+from cPickle import dump as pickle, load as unpickle
 from math import pi
 
 import logging
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)08s - %(message)s')
 
 from Skeletron import waynode_multilines
-from Skeletron.input import parse_route_relation_waynodes
-from Skeletron.output import multilines_geojson
+from Skeletron.input import parse_route_relations, route_relation_waynodes, update_route_relation_waynodes
+from Skeletron.output import multilines_geojson, update_multilines_geojson
 from Skeletron.util import open_file
+from Skeletron.cache import Cache
 
 earth_radius = 6378137
 
 optparser = OptionParser(usage="""%prog [options] <osm input file> <geojson output file>
 
-Accepts OpenStreetMap XML input and generates GeoJSON output for routes
+Accepts OpenStreetMap XML or PBF input and generates GeoJSON output for routes
 using the "network", "ref" and "modifier" tags to group relations.
-More on route relations: http://wiki.openstreetmap.org/wiki/Relation:route""")
+More on route relations: http://wiki.openstreetmap.org/wiki/Relation:route
+
+Input file names ending in ".pbf" are read as PBF.""")
 
-defaults = dict(zoom=12, width=15, merge_highways='no')
+defaults = dict(zoom=12, width=15, merge_highways='no', workers=1, cache=None, cache_size=100, save_state=None, update_state=None, two_pass=False)
 
 optparser.set_defaults(**defaults)
 
@@ -43,21 +47,68 @@ optparser.add_option('-w', '--width', dest='width',
 optparser.add_option('--merge-highways', dest='merge_highways',
                      choices=('yes', 'no', 'largest'), help='Highway merging behavior: "yes" merges highway tags (e.g. collapses primary and secondary) when they share a network and ref tag, "no" keeps them separate, and "largest" merges but outputs the value of the largest highway (e.g. motorway). Default value is "%s".' % defaults['merge_highways'])
 
+optparser.add_option('--workers', dest='workers',
+                     type='int', help='Number of worker processes for generalizing routes and for decoding PBF input in parallel. Default value is %s.' % repr(defaults['workers']))
+
+optparser.add_option('--cache', dest='cache',
+                     help='Optional directory for caching generalized results between runs.')
+
+optparser.add_option('--cache-size', dest='cache_size',
+                     type='int', help='Maximum size of cache directory in megabytes. Default value is %s.' % repr(defaults['cache_size']))
+
+optparser.add_option('--two-pass', dest='two_pass',
+                     action='store_true', help='Read input twice, keeping only nodes used by ways in route relations to save memory on large extracts. Input must be a file and not stdin. Can\'t be used with --save-state, because an update may need nodes that weren\'t kept.')
+
+optparser.add_option('--save-state', dest='save_state',
+                     help='Optional file for saving parsed relations, ways and nodes, for a later run with --update-state. Can\'t be used with --two-pass.')
+
+optparser.add_option('--update-state', dest='update_state',
+                     help='Optional file of parsed relations, ways and nodes from an earlier run with --save-state. Input is then an osmChange file of edits since that run, and only affected routes are regenerated and patched into the existing GeoJSON output file. Use --save-state to keep the updated state for the next run.')
+
 if __name__ == '__main__':
-    
+
     options, (input_file, output_file) = optparser.parse_args()
     
+    if options.two_pass and options.save_state:
+        optparser.error('--two-pass keeps only nodes used by the current ways, and can\'t be used with --save-state')
+    
     buffer = options.width / 2
     buffer *= (2 * pi * earth_radius) / (2**(options.zoom + 8))
     
+    # Options that must match between saved and updated states.
+    state_options = options.zoom, options.width, options.merge_highways
+    
     #
     # Input
     #
     
     input = open_file(input_file, 'r')
+    pbf = input_file.endswith('.pbf')
     
-    ways, nodes = parse_route_relation_waynodes(input, options.merge_highways)
-    multilines = waynode_multilines(ways, nodes)
+    if options.update_state:
+        state_file = open_file(options.update_state, 'rb')
+        state = unpickle(state_file)
+        state_file.close()
+        
+        if state['options'] != state_options:
+            optparser.error('Zoom, width and highway merging options must match those of the saved state: %s' % repr(state['options']))
+        
+        rels, ways, nodes = state['rels'], state['ways'], state['nodes']
+        rel_ways, keys = update_route_relation_waynodes(input, rels, ways, nodes, options.merge_highways)
+        
+        changed_ways = dict([(id, way) for (id, way) in rel_ways.items() if way['key'] in keys])
+        multilines = waynode_multilines(changed_ways, nodes)
+    
+    else:
+        rels, ways, nodes = parse_route_relations(input, options.two_pass, pbf, options.workers)
+        rel_ways = route_relation_waynodes(rels, ways, options.merge_highways)
+        multilines = waynode_multilines(rel_ways, nodes)
+    
+    if options.save_state:
+        state = dict(options=state_options, rels=rels, ways=ways, nodes=nodes)
+        state_file = open_file(options.save_state, 'wb')
+        pickle(state, state_file, 2)
+        state_file.close()
     
     #
     # Output
@@ -73,9 +124,19 @@ if __name__ == '__main__':
         def key_properties((network, ref, modifier, highway)):
             return dict(network=network, ref=ref, modifier=modifier, highway=highway,
                         zoomlevel=options.zoom, pixelwidth=options.width)
-
+    
     logging.info('Buffer: %(buffer).1f, density: %(density).1f, minimum length: %(min_length).1f, minimum area: %(min_area).1f.' % kwargs)
-
-    geojson = multilines_geojson(multilines, key_properties, **kwargs)
+    
+    cache = options.cache and Cache(options.cache, options.cache_size * 1024 * 1024)
+    
+    if options.update_state:
+        geojson = load(open_file(output_file, 'r'))
+        geojson = update_multilines_geojson(geojson, multilines, keys, key_properties, workers=options.workers, cache=cache, **kwargs)
+    else:
+        geojson = multilines_geojson(multilines, key_properties, workers=options.workers, cache=cache, **kwargs)
+    
     output = open_file(output_file, 'w')
     dump(geojson, output)
+    
+    if cache:
+        logging.info('Cache: %d hits, %d misses' % (cache.hits, cache.misses))
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 """ Run with "--help" flag for more information.
 
-Accepts OpenStreetMap XML input and generates GeoJSON output for streets
+Accepts OpenStreetMap XML or PBF input and generates GeoJSON output for streets
 using the "name" and "highway" tags to group collections of ways.
 """
 
@@ -10,24 +10,28 @@ from itertools import combinations
 from optparse import OptionParser
 from csv import DictReader
 from re import compile
-from json import dump
+from json import dump, load
+from cPickle import dump as pickle, load as unpickle
 from math import pi
 
 from StreetNames import short_street_name
 
 from Skeletron import waynode_multilines
-from Skeletron.input import parse_street_waynodes
-from Skeletron.output import multilines_geojson
+from Skeletron.input import parse_street_waynodes, update_street_waynodes
+from Skeletron.output import multilines_geojson, update_multilines_geojson
 from Skeletron.util import open_file
+from Skeletron.cache import Cache
 
 earth_radius = 6378137
 
 optparser = OptionParser(usage="""%prog [options] <osm input file> <geojson output file>
 
-Accepts OpenStreetMap XML input and generates GeoJSON output for streets
-using the "name" and "highway" tags to group collections of ways.""")
+Accepts OpenStreetMap XML or PBF input and generates GeoJSON output for streets
+using the "name" and "highway" tags to group collections of ways.
+
+Input file names ending in ".pbf" are read as PBF.""")
 
-defaults = dict(zoom=12, width=10, use_highway=True)
+defaults = dict(zoom=12, width=10, use_highway=True, workers=1, cache=None, cache_size=100, save_state=None, update_state=None, two_pass=False)
 
 optparser.set_defaults(**defaults)
 
@@ -40,21 +44,67 @@ optparser.add_option('-w', '--width', dest='width',
 optparser.add_option('--ignore-highway', dest='use_highway',
                      action='store_false', help='Ignore differences between highway tags (e.g. collapse primary and secondary) when they share a name.')
 
+optparser.add_option('--workers', dest='workers',
+                     type='int', help='Number of worker processes for generalizing streets and for decoding PBF input in parallel. Default value is %s.' % repr(defaults['workers']))
+
+optparser.add_option('--cache', dest='cache',
+                     help='Optional directory for caching generalized results between runs.')
+
+optparser.add_option('--cache-size', dest='cache_size',
+                     type='int', help='Maximum size of cache directory in megabytes. Default value is %s.' % repr(defaults['cache_size']))
+
+optparser.add_option('--two-pass', dest='two_pass',
+                     action='store_true', help='Read input twice, keeping only nodes used by streets to save memory on large extracts. Input must be a file and not stdin. Can\'t be used with --save-state, because an update may need nodes that weren\'t kept.')
+
+optparser.add_option('--save-state', dest='save_state',
+                     help='Optional file for saving parsed ways and nodes, for a later run with --update-state. Can\'t be used with --two-pass.')
+
+optparser.add_option('--update-state', dest='update_state',
+                     help='Optional file of parsed ways and nodes from an earlier run with --save-state. Input is then an osmChange file of edits since that run, and only affected streets are regenerated and patched into the existing GeoJSON output file. Use --save-state to keep the updated state for the next run.')
+
 if __name__ == '__main__':
-    
+
     options, (input_file, output_file) = optparser.parse_args()
     
+    if options.two_pass and options.save_state:
+        optparser.error('--two-pass keeps only nodes used by the current ways, and can\'t be used with --save-state')
+    
     buffer = options.width / 2
     buffer *= (2 * pi * earth_radius) / (2**(options.zoom + 8))
     
+    # Options that must match between saved and updated states.
+    state_options = options.zoom, options.width, options.use_highway
+    
     #
     # Input
     #
     
     input = open_file(input_file, 'r')
+    pbf = input_file.endswith('.pbf')
     
-    ways, nodes = parse_street_waynodes(input, options.use_highway)
-    multilines = waynode_multilines(ways, nodes)
+    if options.update_state:
+        state_file = open_file(options.update_state, 'rb')
+        state = unpickle(state_file)
+        state_file.close()
+        
+        if state['options'] != state_options:
+            optparser.error('Zoom, width and highway options must match those of the saved state: %s' % repr(state['options']))
+        
+        ways, nodes = state['ways'], state['nodes']
+        keys = update_street_waynodes(input, ways, nodes, options.use_highway)
+        
+        changed_ways = dict([(id, way) for (id, way) in ways.items() if way['key'] in keys])
+        multilines = waynode_multilines(changed_ways, nodes)
+    
+    else:
+        ways, nodes = parse_street_waynodes(input, options.use_highway, options.two_pass, pbf, options.workers)
+        multilines = waynode_multilines(ways, nodes)
+    
+    if options.save_state:
+        state = dict(options=state_options, ways=ways, nodes=nodes)
+        state_file = open_file(options.save_state, 'wb')
+        pickle(state, state_file, 2)
+        state_file.close()
     
     #
     # Output
@@ -72,10 +122,20 @@ if __name__ == '__main__':
             return dict(name=name,
                         zoomlevel=options.zoom, pixelwidth=options.width,
                         shortname=short_street_name(name))
-
+    
     print >> stderr, 'Buffer: %(buffer).1f, density: %(density).1f, minimum length: %(min_length).1f, minimum area: %(min_area).1f.' % kwargs
     print >> stderr, '-' * 20
-
-    geojson = multilines_geojson(multilines, key_properties, **kwargs)
+    
+    cache = options.cache and Cache(options.cache, options.cache_size * 1024 * 1024)
+    
+    if options.update_state:
+        geojson = load(open_file(output_file, 'r'))
+        geojson = update_multilines_geojson(geojson, multilines, keys, key_properties, workers=options.workers, cache=cache, **kwargs)
+    else:
+        geojson = multilines_geojson(multilines, key_properties, workers=options.workers, cache=cache, **kwargs)
+    
     output = open_file(output_file, 'w')
     dump(geojson, output)
+    
+    if cache:
+        print >> stderr, 'Cache: %d hits, %d misses' % (cache.hits, cache.misses)
@@ -3,28 +3,89 @@ from sys import stdout, stderr
 from bz2 import BZ2File
 from xml.etree.ElementTree import Element, ElementTree
 from itertools import count
-from multiprocessing import JoinableQueue, Process
+from multiprocessing import Queue, Process, Value
+from traceback import print_exc
+from optparse import OptionParser
+from Queue import Full
 
 from psycopg2 import connect
 from shapely.geometry import LineString
 
-def write_groups(queue):
+from Skeletron import mercator_lines
+
+optparser = OptionParser(usage="""%prog [options]
+
+Dumps route relations from an osm2pgsql database with slim tables
+to numbered OpenStreetMap XML files for skeletron-osm-route-rels.py.""")
+
+defaults = dict(host='localhost', user='gis', database='gis', password='gis', batch_size=1000, workers=1, writers=1)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('--host', dest='host',
+                     help='Database host. Default value is %s.' % repr(defaults['host']))
+
+optparser.add_option('--user', dest='user',
+                     help='Database user. Default value is %s.' % repr(defaults['user']))
+
+optparser.add_option('--database', dest='database',
+                     help='Database name. Default value is %s.' % repr(defaults['database']))
+
+optparser.add_option('--password', dest='password',
+                     help='Database password. Default value is %s.' % repr(defaults['password']))
+
+optparser.add_option('--batch-size', dest='batch_size',
+                     type='int', help='Number of relations to look up ways for in each query. Default value is %s.' % repr(defaults['batch_size']))
+
+optparser.add_option('--workers', dest='workers',
+                     type='int', help='Number of worker processes extracting relations from the database, each with its own connection. Default value is %s.' % repr(defaults['workers']))
+
+optparser.add_option('--writers', dest='writers',
+                     type='int', help='Number of worker processes compressing and writing output files. Default value is %s.' % repr(defaults['writers']))
+
+def write_groups(queue, counter):
+    ''' Write groups from a queue to numbered files until a None group arrives.
+        
+        Numbers come from a counter shared with any other writer processes.
     '''
+    for group in iter(queue.get, None):
+        with counter.get_lock():
+            counter.value += 1
+            name = 'routes-%06d.osm.bz2' % counter.value
+        
+        try:
+            tree = make_group_tree(group)
+            file = BZ2File(name, mode='w')
+            
+            tree.write(file)
+            file.close()
+        
+        except Exception:
+            # keep taking groups so the queue doesn't back up.
+            print_exc()
+
+def extract_groups(tasks, groups, connect_args, srid):
+    ''' Put groups for batches of relations from one queue on another until a None batch arrives.
+        
+        Each extraction process has its own database connection.
     '''
-    names = ('routes-%06d.osm.bz2' % id for id in count(1))
+    conn = connect(**connect_args)
     
-    while True:
+    for batch in iter(tasks.get, None):
         try:
-            group = queue.get(timeout=300)
-        except:
-            print 'bah'
-            break
+            for group in gen_relation_groups(conn, batch, srid):
+                groups.put(group)
+                
+                print >> stderr, '-->', len(group), 'relations'
+                print >> stderr, '-' * 80
         
-        tree = make_group_tree(group)
-        file = BZ2File(names.next(), mode='w')
-
-        tree.write(file)
-        file.close()
+        except Exception:
+            # keep taking batches so the queue doesn't back up.
+            print_exc()
+        
+        conn.rollback()
+    
+    conn.close()
 
 def get_relations_list(db):
     '''
@@ -67,98 +128,96 @@ def get_relations_list(db):
     
     return relations
 
-def get_relation_ways(db, rel_id):
+def get_srid(db):
     '''
     '''
-    rel_ids = [rel_id]
-    rels_seen = set()
-    way_ids = set()
+    db.execute('SELECT ST_SRID(way) FROM planet_osm_point LIMIT 1')
     
-    while rel_ids:
-        rel_id = rel_ids.pop(0)
-        
-        if rel_id in rels_seen:
-            break
-        
-        rels_seen.add(rel_id)
-        
-        db.execute('''SELECT members
-                      FROM planet_osm_rels
-                      WHERE id = %d''' \
-                    % rel_id)
-        
-        try:
-            (members, ) = db.fetchone()
-
-        except TypeError:
-            # missing relation
-            continue
-        
-        if not members:
-            continue
-        
-        for member in members[0::2]:
-            if member.startswith('r'):
-                rel_ids.append(int(member[1:]))
-            
-            elif member.startswith('w'):
-                way_ids.add(int(member[1:]))
+    (srid, ) = db.fetchone()
+    
+    if srid not in (4326, 900913):
+        raise Exception('Unknown SRID %d' % srid)
     
-    return way_ids
+    return srid
 
-def get_way_tags(db, way_id):
-    '''
+def get_relations_ways(db, rel_ids):
+    ''' Return a dictionary of way id sets for a list of relation ids.
+        
+        Subrelations are followed to any depth in a single recursive query,
+        and UNION rather than UNION ALL keeps it from looping forever.
     '''
-    db.execute('''SELECT tags
-                  FROM planet_osm_ways
-                  WHERE id = %d''' \
-                % way_id)
+    db.execute('''WITH RECURSIVE rel_members (top_id, rel_id) AS (
+                    SELECT id, id
+                    FROM planet_osm_rels
+                    WHERE id = ANY(%s::bigint[])
+                  UNION
+                    SELECT rel_members.top_id, substr(rels.members[i], 2)::bigint
+                    FROM rel_members
+                    JOIN planet_osm_rels AS rels ON rels.id = rel_members.rel_id
+                    CROSS JOIN generate_subscripts(rels.members, 1) AS i
+                    WHERE i %% 2 = 1 AND rels.members[i] LIKE 'r%%'
+                  )
+                  SELECT rel_members.top_id, substr(rels.members[i], 2)::bigint
+                  FROM rel_members
+                  JOIN planet_osm_rels AS rels ON rels.id = rel_members.rel_id
+                  CROSS JOIN generate_subscripts(rels.members, 1) AS i
+                  WHERE i %% 2 = 1 AND rels.members[i] LIKE 'w%%'
+                  ''',
+               (list(rel_ids), ))
     
-    try:
-        (tags, ) = db.fetchone()
-        tags = dict([keyval for keyval in zip(tags[0::2], tags[1::2])])
-
-    except TypeError:
-        # missing way
-        return dict()
+    rel_ways = dict([(rel_id, set()) for rel_id in rel_ids])
     
-    return tags
+    for (rel_id, way_id) in db.fetchall():
+        rel_ways[rel_id].add(way_id)
+    
+    return rel_ways
 
-def get_way_linestring(db, way_id):
-    '''
+def get_ways(conn, way_ids, srid):
+    ''' Return dictionaries of tags and linestrings for a list of way ids.
+        
+        Ways are read through a server-side cursor, and projected all at
+        once for SRID 900913. Missing ways and ways with fewer than
+        two nodes are left out of the linestrings dictionary.
     '''
-    db.execute('SELECT SRID(way) FROM planet_osm_point LIMIT 1')
+    db = conn.cursor('ways')
     
-    (srid, ) = db.fetchone()
+    db.execute('''SELECT ways.id, ways.tags, coords.lons, coords.lats
+                  FROM planet_osm_ways AS ways
+                  LEFT JOIN (
+                    SELECT ways.id,
+                      array_agg(nodes.lon ORDER BY i) AS lons,
+                      array_agg(nodes.lat ORDER BY i) AS lats
+                    FROM planet_osm_ways AS ways
+                    CROSS JOIN generate_subscripts(ways.nodes, 1) AS i
+                    JOIN planet_osm_nodes AS nodes ON nodes.id = ways.nodes[i]
+                    WHERE ways.id = ANY(%s::bigint[])
+                    GROUP BY ways.id
+                  ) AS coords ON coords.id = ways.id
+                  WHERE ways.id = ANY(%s::bigint[])
+                  ''',
+               (list(way_ids), list(way_ids)))
     
-    if srid not in (4326, 900913):
-        raise Exception('Unknown SRID %d' % srid)
+    way_tags, way_coords = dict(), dict()
     
-    db.execute('''SELECT X(location) AS lon, Y(location) AS lat
-                  FROM (
-                    SELECT
-                      CASE
-                      WHEN %s = 900913
-                      THEN Transform(SetSRID(MakePoint(n.lon * 0.01, n.lat * 0.01), 900913), 4326)
-                      WHEN %s = 4326
-                      THEN MakePoint(n.lon * 0.0000001, n.lat * 0.0000001)
-                      END AS location
-                    FROM (
-                      SELECT unnest(nodes)::int AS id
-                      FROM planet_osm_ways
-                      WHERE id = %d
-                    ) AS w,
-                    planet_osm_nodes AS n
-                    WHERE n.id = w.id
-                  ) AS points''' \
-                % (srid, srid, way_id))
-    
-    coords = db.fetchall()
-    
-    if len(coords) < 2:
-        return None
+    for (way_id, tags, lons, lats) in db:
+        way_tags[way_id] = dict(zip((tags or [])[0::2], (tags or [])[1::2]))
+        
+        if lons and len(lons) >= 2:
+            way_coords[way_id] = zip(lons, lats)
     
-    return LineString(coords)
+    db.close()
+    
+    way_ids = way_coords.keys()
+    
+    if srid == 900913:
+        coords = [[(x * 0.01, y * 0.01) for (x, y) in way_coords[way_id]] for way_id in way_ids]
+        coords = mercator_lines(coords, inverse=True)
+    else:
+        coords = [[(x * 0.0000001, y * 0.0000001) for (x, y) in way_coords[way_id]] for way_id in way_ids]
+    
+    way_lines = dict([(way_id, LineString(line)) for (way_id, line) in zip(way_ids, coords)])
+    
+    return way_tags, way_lines
 
 def cascaded_union(shapes):
     '''
@@ -193,33 +252,92 @@ def relation_key(tags):
     '''
     return (tags.get('network', ''), tags.get('ref', ''), tags.get('modifier', ''))
 
-def gen_relation_groups(relations):
-    '''
+def gen_relation_batches(relations, batch_size):
+    ''' Generate lists of relations sorted by key, each ending where a key does.
     '''
     relation_keys = [relation_key(tags) for (id, tags) in relations]
     
-    group, coords, last_key = [], 0, None
+    batch, last_key = [], None
     
     for (key, (id, tags)) in sorted(zip(relation_keys, relations)):
+        
+        if len(batch) >= batch_size and key != last_key:
+            yield batch
+            batch = []
+        
+        batch.append((id, tags))
+        last_key = key
+    
+    if batch:
+        yield batch
 
+def gen_relation_groups(conn, batch, srid):
+    ''' Generate groups of relations with their way tags and lines for one batch.
+    '''
+    #
+    # Look up ways for the whole batch of relations at once,
+    # instead of making several queries for every single way.
+    #
+    db = conn.cursor()
+    rel_ways = get_relations_ways(db, [id for (id, tags) in batch])
+    way_tags, way_lines = get_ways(conn, set().union(*rel_ways.values()), srid)
+    
+    group, coords, last_key = [], 0, None
+    
+    for (id, tags) in batch:
+        key = relation_key(tags)
+        
         if coords > 100000 and key != last_key:
             yield group
             group, coords = [], 0
         
-        way_ids = get_relation_ways(db, id)
-        way_tags = [get_way_tags(db, way_id) for way_id in way_ids]
-        way_lines = [get_way_linestring(db, way_id) for way_id in way_ids]
-        rel_coords = sum([len(line.coords) for line in way_lines if line])
-        #multiline = cascaded_union(way_lines)
+        way_ids = rel_ways[id]
+        rel_way_tags = [way_tags.get(way_id, dict()) for way_id in way_ids]
+        rel_way_lines = [way_lines.get(way_id, None) for way_id in way_ids]
+        rel_coords = sum([len(line.coords) for line in rel_way_lines if line])
+        #multiline = cascaded_union(rel_way_lines)
         
         print >> stderr, ', '.join(key), '--', rel_coords, 'nodes'
         
-        group.append((id, tags, way_tags, way_lines))
+        group.append((id, tags, rel_way_tags, rel_way_lines))
         coords += rel_coords
         last_key = key
-
+    
     yield group
 
+def check_processes(processes, others):
+    ''' Raise an exception if every one of a list of processes has died.
+        
+        Other processes that would be left waiting on them forever,
+        blocked on a full queue or an empty one, are terminated first.
+    '''
+    if processes and not [process for process in processes if process.is_alive()]:
+        for process in others:
+            process.terminate()
+        
+        raise Exception('No worker processes left')
+
+def put_task(queue, task, processes, downstream=[]):
+    ''' Put a task on a bounded queue, unless every process taking from it has died.
+        
+        Optional downstream processes take the output of processes,
+        and if they have all died there's no point in waiting either.
+    '''
+    while True:
+        try:
+            return queue.put(task, timeout=5)
+        except Full:
+            check_processes(processes, downstream)
+            check_processes(downstream, processes)
+
+def join_processes(processes, downstream):
+    ''' Wait for processes to finish, unless every downstream process has died.
+    '''
+    for process in processes:
+        while process.is_alive():
+            check_processes(downstream, processes)
+            process.join(5)
+
 def make_group_tree(group):
     '''
     '''
@@ -260,19 +378,50 @@ def make_group_tree(group):
 
 if __name__ == '__main__':
 
-    queue = JoinableQueue()
+    options, args = optparser.parse_args()
     
-    group_writer = Process(target=write_groups, args=(queue, ))
-    group_writer.start()
+    connect_args = dict(host=options.host, user=options.user, database=options.database, password=options.password)
     
-    db = connect(host='localhost', user='gis', database='gis', password='gis').cursor()
+    conn = connect(**connect_args)
+    db = conn.cursor()
     
+    srid = get_srid(db)
     relations = get_relations_list(db)
     
-    for group in gen_relation_groups(relations):
-        queue.put(group)
-
-        print >> stderr, '-->', len(group), 'relations'
-        print >> stderr, '-' * 80
+    conn.close()
+    
+    #
+    # Relations go through two stages of processes: batches of relations
+    # are extracted from the database into groups, and groups are written
+    # to files. Queues between them are bounded, so a slow stage holds
+    # back the one before it instead of filling up memory.
+    #
+    tasks, groups = Queue(2 * options.workers), Queue(2 * options.writers)
+    counter = Value('i', 0)
+    
+    extractors = [Process(target=extract_groups, args=(tasks, groups, connect_args, srid))
+                  for i in range(options.workers)]
+    
+    writers = [Process(target=write_groups, args=(groups, counter))
+               for i in range(options.writers)]
+    
+    for process in extractors + writers:
+        process.start()
+    
+    for batch in gen_relation_batches(relations, options.batch_size):
+        put_task(tasks, batch, extractors, writers)
+    
+    #
+    # One None for each process in a stage tells it there's no more work,
+    # and the next stage is told once the one before it has finished.
+    #
+    for process in extractors:
+        put_task(tasks, None, extractors, writers)
+    
+    join_processes(extractors, writers)
+    
+    for process in writers:
+        put_task(groups, None, writers)
     
-    group_writer.join()
+    for process in writers:
+        process.join()
@@ -0,0 +1,198 @@
+""" Writer of small OpenStreetMap PBF fixtures from OSM XML, for tests.
+
+Nothing here is used by Skeletron itself. The encoder covers just the
+parts of the format that Skeletron.pbf reads: dense or plain nodes,
+ways, relations, zlib or raw blobs, and coordinate offsets.
+
+    python tests/pbf_fixture.py input.osm output.pbf
+"""
+from xml.etree.cElementTree import iterparse
+from optparse import OptionParser
+from struct import pack
+from zlib import compress
+
+def _varint(value):
+    """ Encode a number as a varint, negative numbers as ten-byte int64.
+    """
+    value &= 0xffffffffffffffff
+    bytes = []
+    
+    while value >= 0x80:
+        bytes.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    
+    return ''.join(bytes) + chr(value)
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _number(number, value):
+    return _varint(number << 3) + _varint(value)
+
+def _string(number, value):
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+def _packed(number, values):
+    return _string(number, ''.join(map(_varint, values)))
+
+def _deltas(values):
+    """ Return a list of zigzag-coded differences between values.
+    """
+    return [_zigzag(value - last) for (value, last) in zip(values, [0] + values[:-1])]
+
+def read_osm(input):
+    """ Read OSM XML input, return lists of nodes, ways and relations.
+        
+        Each is a dictionary with id, tags, and lat and lon for nodes,
+        refs for ways, or members of (type, ref, role) for relations.
+    """
+    elements = dict(node=[], way=[], relation=[])
+    element = None
+    
+    for (event, elem) in iterparse(input, events=('start', 'end')):
+        if event == 'start' and elem.tag in elements:
+            element = dict(id=int(elem.get('id')), tags=[], refs=[], members=[])
+            
+            if elem.tag == 'node':
+                element.update(lat=elem.get('lat'), lon=elem.get('lon'))
+        
+        elif event == 'start' and elem.tag == 'tag':
+            element['tags'].append((elem.get('k'), elem.get('v')))
+        
+        elif event == 'start' and elem.tag == 'nd':
+            element['refs'].append(int(elem.get('ref')))
+        
+        elif event == 'start' and elem.tag == 'member':
+            element['members'].append((elem.get('type'), int(elem.get('ref')), elem.get('role', '')))
+        
+        elif event == 'end' and elem.tag in elements:
+            elements[elem.tag].append(element)
+            elem.clear()
+    
+    return elements['node'], elements['way'], elements['relation']
+
+def _nanodegrees(degrees):
+    """ Convert a decimal degrees string to an exact integer of nanodegrees.
+    """
+    sign = degrees.startswith('-') and -1 or 1
+    whole, part = (degrees.lstrip('-') + '.').split('.')[:2]
+    
+    return sign * (int(whole or 0) * 10**9 + int((part + '0' * 9)[:9]))
+
+class _StringTable:
+    """ Strings of one block, with the empty string first as required.
+    """
+    def __init__(self):
+        self.strings, self.index = [''], {'': 0}
+    
+    def __call__(self, string):
+        string = string.encode('utf8')
+        
+        if string not in self.index:
+            self.index[string] = len(self.strings)
+            self.strings.append(string)
+        
+        return self.index[string]
+    
+    def encode(self):
+        return _string(1, ''.join([_string(1, string) for string in self.strings]))
+
+def _block(kind, elements, dense, granularity, lat_offset, lon_offset):
+    """ Encode a PrimitiveBlock with one group of nodes, ways or relations.
+    """
+    table, group = _StringTable(), []
+    
+    if kind == 'node':
+        ids = [node['id'] for node in elements]
+        lats = [(_nanodegrees(node['lat']) - lat_offset) // granularity for node in elements]
+        lons = [(_nanodegrees(node['lon']) - lon_offset) // granularity for node in elements]
+        
+        if dense:
+            keys_vals = []
+            
+            for node in elements:
+                for (key, value) in node['tags']:
+                    keys_vals += [table(key), table(value)]
+                
+                keys_vals.append(0)
+            
+            group.append(_string(2, _packed(1, _deltas(ids)) + _packed(8, _deltas(lats))
+                                    + _packed(9, _deltas(lons)) + _packed(10, keys_vals)))
+        
+        else:
+            for (node, id, lat, lon) in zip(elements, ids, lats, lons):
+                group.append(_string(1, _number(1, _zigzag(id))
+                                        + _packed(2, [table(key) for (key, value) in node['tags']])
+                                        + _packed(3, [table(value) for (key, value) in node['tags']])
+                                        + _number(8, _zigzag(lat)) + _number(9, _zigzag(lon))))
+    
+    elif kind == 'way':
+        for way in elements:
+            group.append(_string(3, _number(1, way['id'])
+                                    + _packed(2, [table(key) for (key, value) in way['tags']])
+                                    + _packed(3, [table(value) for (key, value) in way['tags']])
+                                    + _packed(8, _deltas(way['refs']))))
+    
+    elif kind == 'relation':
+        types = dict(node=0, way=1, relation=2)
+        
+        for rel in elements:
+            group.append(_string(4, _number(1, rel['id'])
+                                    + _packed(2, [table(key) for (key, value) in rel['tags']])
+                                    + _packed(3, [table(value) for (key, value) in rel['tags']])
+                                    + _packed(8, [table(role) for (type, ref, role) in rel['members']])
+                                    + _packed(9, _deltas([ref for (type, ref, role) in rel['members']]))
+                                    + _packed(10, [types[type] for (type, ref, role) in rel['members']])))
+    
+    return table.encode() + _string(2, ''.join(group)) + _number(17, granularity) \
+         + _number(19, lat_offset) + _number(20, lon_offset)
+
+def _file_block(type, data, compressed):
+    """ Encode a BlobHeader and Blob around a block of data.
+    """
+    if compressed:
+        blob = _number(2, len(data)) + _string(3, compress(data))
+    else:
+        blob = _string(1, data)
+    
+    header = _string(1, type) + _number(3, len(blob))
+    
+    return pack('>I', len(header)) + header + blob
+
+def osm_pbf(nodes, ways, rels, block_size=8000, dense=True, compressed=True, granularity=100, lat_offset=0, lon_offset=0):
+    """ Return a string of PBF data for lists of elements from read_osm().
+        
+        Elements are written block_size at a time, nodes then ways then
+        relations. Coordinates must be whole multiples of granularity
+        nanodegrees away from lat_offset and lon_offset.
+    """
+    header = _string(4, 'OsmSchema-V0.6') + _string(4, 'DenseNodes') + _string(16, 'pbf_fixture.py')
+    blocks = [_file_block('OSMHeader', header, compressed)]
+    
+    for (kind, elements) in (('node', nodes), ('way', ways), ('relation', rels)):
+        for offset in range(0, len(elements), block_size):
+            data = _block(kind, elements[offset:offset+block_size], dense, granularity, lat_offset, lon_offset)
+            blocks.append(_file_block('OSMData', data, compressed))
+    
+    return ''.join(blocks)
+
+parser = OptionParser(usage="""%prog [options] <osm input file> <pbf output file>""")
+
+parser.set_defaults(block_size=8000, plain=False, raw=False)
+
+parser.add_option('--block-size', dest='block_size', type='int',
+                  help='Number of elements in each block. Default value is %s.' % repr(parser.defaults['block_size']))
+
+parser.add_option('--plain', dest='plain', action='store_true',
+                  help='Write plain nodes instead of dense nodes.')
+
+parser.add_option('--raw', dest='raw', action='store_true',
+                  help='Write uncompressed blobs instead of zlib.')
+
+if __name__ == '__main__':
+    options, (input_file, output_file) = parser.parse_args()
+    
+    nodes, ways, rels = read_osm(open(input_file))
+    pbf = osm_pbf(nodes, ways, rels, options.block_size, not options.plain, not options.raw)
+    
+    open(output_file, 'wb').write(pbf)
@@ -0,0 +1,127 @@
+""" Round-trip tests of Skeletron.pbf against the OSM XML parser.
+
+OSM XML is generated here, converted to PBF by pbf_fixture.py, and both
+are parsed to check that ParserPBF gives the same results as ParserOSM.
+
+    python -m unittest discover tests
+"""
+from StringIO import StringIO
+from xml.sax.saxutils import quoteattr
+from random import Random
+import unittest
+
+from Skeletron.input import ParserOSM, ParserPBF, name_highway_key, name_highway_ref_key, network_ref_modifier_key
+from pbf_fixture import read_osm, osm_pbf
+
+def _fixture_osm(seed=1):
+    """ Return a string of OSM XML with a small network of tagged ways and route relations.
+    """
+    random = Random(seed)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    node_ids = []
+    
+    for index in range(400):
+        # Some negative ids, as in unsaved edits, and a few big gaps.
+        id = index < 20 and -1 - index or index * random.choice((1, 1, 1, 9999991))
+        lat, lon = random.uniform(-85, 85), random.uniform(-180, 180)
+        lines.append('<node id="%d" lat="%.7f" lon="%.7f"/>' % (id, lat, lon))
+        node_ids.append(id)
+    
+    names = [u'Broadway', u'Stra\xdfe', u'Avenue "A"', None]
+    highways = ['primary', 'primary_link', 'residential', None]
+    way_ids = []
+    
+    for index in range(60):
+        id = index < 5 and -1 - index or 1000 + index * 37
+        refs = random.sample(node_ids, random.randint(0, 8))
+        name, highway = random.choice(names), random.choice(highways)
+        
+        lines.append('<way id="%d">' % id)
+        lines += ['<nd ref="%d"/>' % ref for ref in refs]
+        lines += name and ['<tag k="name" v=%s/>' % quoteattr(name.encode('utf8'))] or []
+        lines += highway and ['<tag k="highway" v="%s"/>' % highway] or []
+        lines += index % 3 and ['<tag k="ref" v="CA %d"/>' % (index % 4)] or []
+        lines.append('</way>')
+        way_ids.append(id)
+    
+    for index in range(12):
+        lines.append('<relation id="%d">' % (5000 + index))
+        lines.append('<member type="node" ref="%d" role="stop"/>' % node_ids[index])
+        lines += ['<member type="way" ref="%d" role=""/>' % ref for ref in random.sample(way_ids, 6)]
+        lines.append('<member type="way" ref="999999" role=""/>')
+        lines += index % 4 and ['<member type="relation" ref="%d" role=""/>' % (5000 + index - 1)] or []
+        lines.append('<tag k="type" v="route"/>')
+        lines.append('<tag k="network" v="US:%s"/>' % ('CA', 'I')[index % 2])
+        lines.append('<tag k="ref" v="%d"/>' % (index % 5))
+        lines += index % 6 == 0 and ['<tag k="modifier" v="Business"/>'] or []
+        lines.append('</relation>')
+    
+    lines.append('</osm>')
+    
+    return '\n'.join(lines)
+
+class PBFRoundTripTests (unittest.TestCase):
+    
+    def setUp(self):
+        self.osm = _fixture_osm()
+        self.elements = read_osm(StringIO(self.osm))
+    
+    def assertSameResults(self, (rels1, ways1, nodes1), (rels2, ways2, nodes2)):
+        self.assertEqual(rels1, rels2)
+        self.assertEqual(sorted(ways1.keys()), sorted(ways2.keys()))
+        
+        for (id, way) in ways1.items():
+            self.assertEqual(way['key'], ways2[id]['key'])
+            self.assertEqual(way['nodes'].tolist(), ways2[id]['nodes'].tolist())
+        
+        self.assertEqual(len(nodes1), len(nodes2))
+        self.assertEqual(nodes1.ids.tolist(), nodes2.ids.tolist())
+        self.assertEqual(nodes1.lats.tolist(), nodes2.lats.tolist())
+        self.assertEqual(nodes1.lons.tolist(), nodes2.lons.tolist())
+    
+    def check(self, pbf, two_pass=False, workers=1):
+        """ Parse XML and PBF with street and route keys, and compare them.
+        """
+        for keys in (dict(way_key=name_highway_key),
+                     dict(way_key=name_highway_ref_key, rel_key=network_ref_modifier_key)):
+            
+            osm_results = ParserOSM(two_pass).parse(StringIO(self.osm), **keys)
+            pbf_results = ParserPBF(two_pass, workers).parse(StringIO(pbf), **keys)
+            
+            self.assertSameResults(osm_results, pbf_results)
+    
+    def test_fixture(self):
+        rels, ways, nodes = ParserOSM().parse(StringIO(self.osm), name_highway_ref_key, network_ref_modifier_key)
+        
+        self.assertTrue(len(rels) == 12 and len(ways) > 30 and len(nodes) == 400)
+        self.assertTrue(min(nodes.ids) < 0 and min(ways.keys(), key=int).startswith('-'))
+        self.assertTrue([part for rel in rels.values() for part in rel['parts'] if part.startswith('rel:')])
+    
+    def test_dense_nodes(self):
+        self.check(osm_pbf(*self.elements))
+    
+    def test_plain_nodes(self):
+        self.check(osm_pbf(dense=False, *self.elements))
+    
+    def test_raw_blobs(self):
+        self.check(osm_pbf(compressed=False, *self.elements))
+    
+    def test_small_blocks(self):
+        self.check(osm_pbf(block_size=7, *self.elements))
+    
+    def test_offsets(self):
+        self.check(osm_pbf(lat_offset=-10**9, lon_offset=-2 * 10**9, *self.elements))
+        self.check(osm_pbf(lat_offset=10**9, lon_offset=2 * 10**9, dense=False, *self.elements))
+    
+    def test_granularity(self):
+        self.check(osm_pbf(granularity=50, *self.elements))
+    
+    def test_two_pass(self):
+        self.check(osm_pbf(block_size=50, *self.elements), two_pass=True)
+    
+    def test_workers(self):
+        self.check(osm_pbf(block_size=50, *self.elements), workers=2)
+        self.check(osm_pbf(block_size=50, *self.elements), two_pass=True, workers=2)
+
+if __name__ == '__main__':
+    unittest.main()